@@ -0,0 +1,18 @@
+"""
+ASGI config for cattube project.
+
+It exposes the ASGI callable as a module-level variable named ``application``, and turns on the async versions of the
+views that wait on remote services.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cattube.settings")
+os.environ.setdefault("ASYNC_VIEWS", "true")
+
+application = get_asgi_application()
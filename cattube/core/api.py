@@ -1,48 +1,75 @@
+import asyncio
 import json
-import traceback
-
+import logging
+from pathlib import PurePosixPath
+from time import monotonic
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from botocore.exceptions import ClientError
+from django.core.exceptions import SuspiciousFileOperation
 from django.core.files.storage import default_storage
+from django.db.models import Max
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.text import get_valid_filename
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_POST
 from rest_framework import status
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.decorators import api_view, parser_classes, authentication_classes, permission_classes
-from rest_framework.parsers import FormParser
+from rest_framework.parsers import FormParser, JSONParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from twelvelabs import NotFoundError
 
-from cattube.core.models import Video
-from cattube.core.serializers import VideoSerializer, NotificationSerializer
-from cattube.core.tasks import do_video_indexing
-from cattube.core.utils import verify_transloadit_signature
-from cattube.settings import TWELVE_LABS_CLIENT, TWELVE_LABS_INDEX_ID
+from cattube.core import metrics
+from cattube.core.models import Video, StatusChange, DeletionJob, record_status_changes
+from cattube.core.serializers import VideoSerializer, NotificationSerializer, DeletionJobSerializer, UploadSerializer, \
+    CompleteUploadSerializer
+from cattube.core.queues import queue_depths
+from cattube.core.tasks import do_video_indexing, do_deletion_job, handle_indexing_notification, prepare_indexing
+from cattube.core.utils import verify_transloadit_signature, verify_twelve_labs_signature, verify_metrics_token, \
+    url_path_join
+from cattube.settings import STATUS_LONG_POLL_TIMEOUT, STATUS_LONG_POLL_INTERVAL, STATUS_POLL_INTERVAL, VIDEOS_PATH, \
+    UPLOAD_PART_URL_EXPIRE
+
+logger = logging.getLogger(__name__)
+
+
+def video_urls(videos):
+    """
+    Get the signed URLs for the videos' thumbnails and originals in one go.
+    """
+    return default_storage.urls([file.name for video in videos for file in [video.thumbnail, video.video] if file])
+
+
+def video_status(video, urls):
+    """
+    The parts of a video that the front end needs to show its progress.
+    """
+    return {
+        'status': video.status,
+        'thumbnail': urls[video.thumbnail.name] if video.thumbnail else None,
+        'original': urls[video.video.name] if video.video else None,
+    }
 
 
 @api_view(['POST'])
 @authentication_classes([SessionAuthentication])
 @permission_classes([IsAuthenticated])
 def index_videos(request):
-    print(f'Indexing videos: {request.data}')
+    logger.info('Indexing videos', extra={'data': request.data})
 
     if request.data.get('selectedAll'):
-        videos = Video.objects.all()
+        videos = Video.objects.filter(deletion_job__isnull=True)
     else:
-        videos = Video.objects.filter(id__in=request.data['videos'])
+        videos = Video.objects.filter(id__in=request.data['videos'], deletion_job__isnull=True)
 
     # Don't index videos that have already been submitted for indexing
     videos = videos.exclude(status__in=['Validating', 'Pending', 'Indexing'])
 
-    # Update status in database so that UI can get it
-    video_dicts = []
-    for video in videos:
-        video.status = 'Sending'
-        video_dicts.append({
-            'id': video.id,
-            'video': video.video.name,
-            'status': 'Sending'
-        })
-    Video.objects.bulk_update(videos, ['status'])
+    video_dicts = prepare_indexing(videos)
 
     # Start a Huey task to create indexing tasks and poll Twelve Labs for status
     do_video_indexing(video_dicts)
@@ -55,68 +82,84 @@ def index_videos(request):
 @permission_classes([IsAuthenticated])
 def delete_videos(request):
     """
-    Delete videos with ids listed in request.data. We try deleting from the B2 storage first, then from the Twelve Labs
-    index, then from the database. At each step, we don't care if it's already been deleted.
+    Delete videos with ids listed in request.data. The videos are hidden from the list straight away, then a
+    background job deletes them from the B2 storage, then from the Twelve Labs index, then from the database. At each
+    step, we don't care if it's already been deleted. Returns the job, so the client can follow its progress.
     """
-    print(f'Deleting videos: {request.data}')
+    logger.info('Deleting videos', extra={'data': request.data})
 
     if request.data.get('selectedAll'):
-        videos = Video.objects.all()
+        videos = Video.objects.filter(deletion_job__isnull=True)
     else:
-        videos = Video.objects.filter(id__in=request.data['videos'])
-
-    # Try deleting from B2 first
-    deleted_from_storage = []
-    file_fields = ['video', 'thumbnail']
-    for video in videos:
-        deletion_failed = False
-        for attr in file_fields:
-            name = getattr(video, attr).name
-            if name:
-                try:
-                    default_storage.delete(name)
-                    setattr(video, attr, None)
-                except Exception as err:
-                    print(f'Cannot delete {name} from storage: {err}')
-                    traceback.print_exception(type(err), err, err.__traceback__)
-                    deletion_failed = True
-        if not deletion_failed:
-            deleted_from_storage.append(video)
-
-    print(f'Deleted from storage: {deleted_from_storage}')
-    Video.objects.bulk_update(deleted_from_storage, ['video'])
-
-    # Now delete from Twelve Labs
-    deleted_from_index = []
-    file_fields = ['thumbnail']
-    for video in deleted_from_storage:
-        try:
-            try:
-                TWELVE_LABS_CLIENT.index.video.delete(TWELVE_LABS_INDEX_ID, video.video_id)
-                video.video_id = ''
-                for attr in file_fields:
-                    setattr(video, attr, None)
-            except NotFoundError:
-                print(f'{video.video_id} not found in index. Carrying on anyway.')
+        videos = Video.objects.filter(id__in=request.data['videos'], deletion_job__isnull=True)
+
+    job = DeletionJob.objects.create()
+    job.total = videos.update(deletion_job=job)
+    job.save(update_fields=['total'])
+    do_deletion_job(job.id)
+
+    return Response(DeletionJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+@never_cache
+@api_view(['GET'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+def deletion_job_detail(_, job_id):
+    """
+    Report the progress of a deletion job.
+    """
+    job = get_object_or_404(DeletionJob, id=job_id)
+    return Response(DeletionJobSerializer(job).data)
+
+
+def current_cursor():
+    """
+    The id of the latest entry in the status change journal.
+    """
+    return StatusChange.objects.aggregate(Max('id'))['id__max'] or 0
+
 
-            deleted_from_index.append(video)
-        except Exception as err:
-            print(f'Cannot delete {video.video_id} from index: {err}')
-            traceback.print_exception(type(err), err, err.__traceback__)
+def changes_since(video_ids, since):
+    """
+    Returns the latest cursor and the set of ids of the videos that have changed since the given cursor, or
+    (since, None) if none of them have.
+    """
+    changes = StatusChange.objects.filter(id__gt=since, video_id__in=video_ids)
+    cursor = changes.aggregate(Max('id'))['id__max']
+    if cursor is None:
+        return since, None
+    return cursor, set(changes.values_list('video_id', flat=True))
 
-    fields_to_update = file_fields
-    fields_to_update.append('video_id')
 
-    print(f'Deleted from index: {deleted_from_index}')
-    Video.objects.bulk_update(deleted_from_index, fields_to_update)
+def videos_data(cursor, video_ids):
+    """
+    The cursor and the status of each of the videos.
+    """
+    videos = list(Video.objects.filter(id__in=video_ids))
+    urls = video_urls(videos)
+    return {
+        'cursor': cursor,
+        'videos': [{'id': video.id, **video_status(video, urls)} for video in videos]
+    }
 
-    # Now delete from the database
-    ids_for_deletion = [video.id for video in deleted_from_index]
-    print(f'Deleting ids: {ids_for_deletion}')
-    deleted, rows_count = Video.objects.filter(id__in=ids_for_deletion).delete()
-    print(f'Deleted {deleted} objects from database: {rows_count}')
 
-    return Response([video.id for video in deleted_from_index])
+def parse_status_request(data):
+    """
+    The video ids and cursor from the body of a request for the status of a set of videos: a dict with 'ids', a list
+    of video ids, and, optionally, 'since', a cursor from a previous response. The ids are in the body, rather than the
+    query string, since there may be too many for a request line. Raises ValueError if the body isn't like that.
+    """
+    try:
+        video_ids = [int(video_id) for video_id in data['ids']]
+        since = data.get('since')
+        return video_ids, int(since) if since is not None else None
+    except (AttributeError, KeyError, TypeError, ValueError) as ex:
+        raise ValueError('Invalid status request') from ex
+
+
+def videos_response(cursor, video_ids):
+    return Response(videos_data(cursor, video_ids))
 
 
 @never_cache
@@ -126,35 +169,203 @@ def delete_videos(request):
 def get_status(request):
     """
     Query the database for the status of the videos passed in request.data.
+
+    request.data may be a list of video dicts, in which case each one is returned with its status, or a dict with
+    'ids', a list of video ids, and, optionally, 'since', a cursor from a previous response. In the latter case, the
+    response contains a cursor and the status of just the videos that have changed since 'since', or of all the
+    videos if there is no 'since'. If none of them have changed, the response is 304 Not Modified.
     """
+    if isinstance(request.data, dict):
+        try:
+            video_ids, since = parse_status_request(request.data)
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if since is None:
+            return videos_response(current_cursor(), video_ids)
+
+        cursor, video_ids = changes_since(video_ids, since)
+        if video_ids is None:
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return videos_response(cursor, video_ids)
+
     video_dicts = request.data
-    print('Getting status: ', video_dicts)
-    video_ids = [video_dict['id'] for video_dict in video_dicts]
-    videos = Video.objects.filter(id__in=video_ids)
+    logger.debug('Getting status', extra={'videos': video_dicts})
+    # Do a single database query for all the videos, rather than one per video
+    videos = Video.objects.in_bulk([video_dict['id'] for video_dict in video_dicts])
 
+    # Videos that have been deleted are left out of the response, so the client stops asking about them
+    video_dicts = [video_dict for video_dict in video_dicts if int(video_dict['id']) in videos]
+    urls = video_urls(videos.values())
     for video_dict in video_dicts:
-        video = videos.get(id__exact=video_dict['id'])
-        video_dict['status'] = video.status
-        video_dict['thumbnail'] = default_storage.url(video.thumbnail.name) if video.thumbnail else None
-        video_dict['original'] = default_storage.url(video.video.name) if video.video else None
+        video_dict.update(video_status(videos[int(video_dict['id'])], urls))
 
-    print(f'Status: {video_dicts}')
+    logger.debug('Status', extra={'videos': video_dicts})
 
     return Response(video_dicts)
 
 
+@never_cache
+@api_view(['POST'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+def get_status_changes(request):
+    """
+    Get changes to the videos with the ids in the request body, as parsed by parse_status_request(). Without 'since',
+    returns the current status of all the videos; otherwise returns the status of the videos that have changed since
+    that cursor. Either way, the response includes a cursor to pass as 'since' in the next request, and the number of
+    seconds to wait before making it. Under WSGI, a request that waited for changes would tie up a worker, so this
+    responds straight away, and the browser polls every STATUS_POLL_INTERVAL seconds. The ASGI entry point uses
+    get_status_changes_async() instead, which waits for changes.
+    """
+    try:
+        video_ids, since = parse_status_request(request.data)
+    except ValueError:
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    if since is None:
+        return Response({**videos_data(current_cursor(), video_ids), 'poll_interval': STATUS_POLL_INTERVAL})
+
+    cursor, changed_ids = changes_since(video_ids, since)
+    if changed_ids is None:
+        return Response({'cursor': since, 'videos': [], 'poll_interval': STATUS_POLL_INTERVAL})
+    return Response({**videos_data(cursor, changed_ids), 'poll_interval': STATUS_POLL_INTERVAL})
+
+
+@never_cache
+@require_POST
+async def get_status_changes_async(request):
+    """
+    Async version of get_status_changes() for the ASGI entry point. Waiting doesn't tie up a thread, so this waits up
+    to STATUS_LONG_POLL_TIMEOUT seconds for a change, checking every STATUS_LONG_POLL_INTERVAL seconds, and the browser
+    asks again straight away.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        video_ids, since = parse_status_request(json.loads(request.body))
+    except ValueError:
+        return JsonResponse({}, status=status.HTTP_400_BAD_REQUEST)
+
+    if since is None:
+        cursor = await sync_to_async(current_cursor)()
+        return JsonResponse({**await sync_to_async(videos_data)(cursor, video_ids), 'poll_interval': 0})
+
+    # Check for changes to just these videos, until there are some, or we time out
+    deadline = monotonic() + STATUS_LONG_POLL_TIMEOUT
+    while True:
+        cursor, changed_ids = await sync_to_async(changes_since)(video_ids, since)
+        if changed_ids is not None:
+            return JsonResponse({**await sync_to_async(videos_data)(cursor, changed_ids), 'poll_interval': 0})
+        if monotonic() + STATUS_LONG_POLL_INTERVAL > deadline:
+            return JsonResponse({'cursor': since, 'videos': [], 'poll_interval': 0})
+        await asyncio.sleep(STATUS_LONG_POLL_INTERVAL)
+
+
 @never_cache
 @api_view(['GET'])
 @authentication_classes([SessionAuthentication])
 @permission_classes([IsAuthenticated])
 def video_detail(_, video_id):
-    print(f'Getting detail: {video_id}')
+    logger.debug('Getting detail', extra={'video_id': video_id})
     video = get_object_or_404(Video, id=video_id)
     serializer = VideoSerializer(video)
-    print(f'Returning : {serializer.data}')
+    logger.debug('Returning detail', extra={'video': serializer.data})
     return Response(serializer.data)
 
 
+@api_view(['POST'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+def create_upload(request):
+    """
+    Start a multipart upload straight to B2, for the browser to upload the file's parts to. A random suffix keeps the
+    file from replacing another with the same name.
+    """
+    try:
+        filename = get_valid_filename(PurePosixPath(request.data.get('filename', '')).name)
+    except SuspiciousFileOperation:
+        return Response({'filename': ['Invalid file name']}, status=status.HTTP_400_BAD_REQUEST)
+
+    path = PurePosixPath(filename)
+    key = url_path_join(VIDEOS_PATH, f'{path.stem}-{uuid4().hex[:8]}{path.suffix}')
+    upload_id = default_storage.create_multipart_upload(key, request.data.get('type'))
+    logger.info('Started upload', extra={'upload_id': upload_id, 'key': key})
+    return Response({'key': key, 'uploadId': upload_id}, status=status.HTTP_201_CREATED)
+
+
+@never_cache
+@api_view(['GET', 'DELETE'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+def multipart_upload(request, upload_id):
+    """
+    List the parts uploaded so far, so the browser can resume an interrupted upload, or abort the upload.
+    """
+    serializer = UploadSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    key = serializer.validated_data['key']
+
+    if request.method == 'DELETE':
+        logger.info('Aborting upload', extra={'upload_id': upload_id, 'key': key})
+        default_storage.abort_multipart_upload(key, upload_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    return Response(default_storage.list_parts(key, upload_id))
+
+
+@never_cache
+@api_view(['GET'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+def sign_upload_part(request, upload_id, part_number):
+    """
+    Presigned URL for the browser to PUT a part of the file to B2.
+    """
+    serializer = UploadSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    url = default_storage.sign_upload_part(serializer.validated_data['key'], upload_id, part_number,
+                                           expire=UPLOAD_PART_URL_EXPIRE)
+    return Response({'url': url})
+
+
+@api_view(['POST'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+def complete_upload(request, upload_id):
+    """
+    Assemble the uploaded parts into the file, then create the video, and, if asked, start indexing it.
+    """
+    serializer = CompleteUploadSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    data = serializer.validated_data
+
+    try:
+        default_storage.complete_multipart_upload(data['key'], upload_id, data['parts'])
+    except ClientError as e:
+        logger.warning('Cannot complete upload', extra={'upload_id': upload_id, 'key': data['key'], 'error': str(e)})
+        return Response({'error': e.response['Error']['Code']}, status=status.HTTP_400_BAD_REQUEST)
+
+    # A scan of the bucket may already have found the file
+    video, _ = Video.objects.update_or_create(video=data['key'],
+                                              defaults={'title': data['title'], 'user': request.user})
+    logger.info('Uploaded video', extra={'video_pk': video.id, 'file': video.video.name})
+    if data['index']:
+        do_video_indexing(prepare_indexing([video]))
+    else:
+        record_status_changes([video])
+
+    # Uppy passes location on as the upload's URL
+    return Response({'id': video.id, 'location': reverse('watch', kwargs={'video_id': video.id})},
+                    status=status.HTTP_201_CREATED)
+
+
 @api_view(['POST'])
 @parser_classes([FormParser])
 def receive_notification_from_transcoder(request):
@@ -163,16 +374,60 @@ def receive_notification_from_transcoder(request):
 
     serializer = NotificationSerializer(data=request.data)
     if serializer.is_valid():
-        print(f'Received notification: {serializer.data}')
+        logger.debug('Received notification from Transloadit', extra={'notification': serializer.data})
 
         # Remove the path prefixes from the object keys
         assembly = json.loads(serializer.data['transloadit'])
 
-        print(f'Getting video for assembly {assembly["assembly_id"]}')
-        video = get_object_or_404(Video, assembly_id=assembly['assembly_id'])
-        video.update_from_assembly(assembly)
+        logger.info('Getting video for assembly', extra={'assembly_id': assembly['assembly_id']})
+        video = get_object_or_404(Video.objects.exclude(assembly_id=''), assembly_id=assembly['assembly_id'])
+        # The poller may have got there first
+        if not video.video:
+            video.update_from_assembly(assembly)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-    print(f'Serializer errors: {serializer.errors}')
+    logger.warning('Invalid notification from Transloadit', extra={'errors': serializer.errors})
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([])
+@parser_classes([JSONParser])
+def receive_notification_from_twelve_labs(request):
+    """
+    Webhook for Twelve Labs indexing task notifications. We hand the task over to a Huey task to retrieve it and update
+    the video, so we can respond straight away.
+    """
+    # Verify the signature against the raw body, before parsing it
+    if not verify_twelve_labs_signature(request.headers.get('TL-Signature'), request.body):
+        return Response(status=status.HTTP_401_UNAUTHORIZED)
+
+    notification = request.data
+    logger.info('Received notification from Twelve Labs', extra={'notification': notification})
+
+    data = notification.get('data') if isinstance(notification, dict) else None
+    task_id = data.get('id') if isinstance(data, dict) else None
+    if not task_id or not isinstance(task_id, str):
+        logger.warning('Invalid notification from Twelve Labs', extra={'notification': notification})
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    if notification.get('type') in ['index.task.ready', 'index.task.failed']:
+        handle_indexing_notification(task_id)
+
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@never_cache
+def export_metrics(request):
+    """
+    Metrics of the web app and the Huey workers, in Prometheus text format, for a scraper that presents METRICS_TOKEN
+    as a bearer token, or for staff users.
+    """
+    if not (verify_metrics_token(request.headers.get('Authorization')) or request.user.is_staff):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+
+    gauges = [(f'queue_{state}_tasks', {'queue': name}, count)
+              for name, depths in queue_depths().items() for state, count in depths.items()]
+    return HttpResponse(metrics.export(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
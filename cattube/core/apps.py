@@ -1,20 +1,45 @@
+import hashlib
+import logging
+import sys
+from time import perf_counter
+
 from django.apps import AppConfig
+from django.core.cache import caches
 from django.core.checks import register, Critical
+from django.db.backends.signals import connection_created
 from twelvelabs import APIStatusError
 
-from cattube.settings import TWELVE_LABS_CLIENT, TWELVE_LABS_INDEX_ID
+from cattube.core import metrics
+from cattube.settings import TWELVE_LABS_CLIENT, TWELVE_LABS_API_KEY, TWELVE_LABS_INDEX_ID, SQLITE_PRAGMAS, \
+    CHECKS_CACHE, TWELVE_LABS_CHECK_TIMEOUT, TWELVE_LABS_CHECK_SKIP_COMMANDS, QUERY_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+# Statement types that queries are labelled with in the metrics; anything else is OTHER
+QUERY_STATEMENTS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE'}
 
 
 # noinspection PyUnusedLocal
 def check_tl_index_exists(app_configs, **kwargs):
     """
-    Get the index from Twelve Labs to validate the API key and index ID.
+    Get the index from Twelve Labs to validate the API key and index ID. Commands in TWELVE_LABS_CHECK_SKIP_COMMANDS
+    skip the check, and a successful check is cached for TWELVE_LABS_CHECK_TIMEOUT seconds, so that starting a command
+    doesn't usually need a round trip to Twelve Labs.
     """
     errors = []
 
+    if len(sys.argv) > 1 and sys.argv[1] in TWELVE_LABS_CHECK_SKIP_COMMANDS:
+        return errors
+
+    # Changing the API key or index ID invalidates the cached result
+    key = 'tl_index_' + hashlib.md5(f'{TWELVE_LABS_API_KEY}:{TWELVE_LABS_INDEX_ID}'.encode()).hexdigest()
+    if caches[CHECKS_CACHE].get(key):
+        return errors
+
     try:
         index = TWELVE_LABS_CLIENT.index.retrieve(TWELVE_LABS_INDEX_ID)
-        print(f'Retrieved index "{str(index.__dict__)}"')
+        logger.info('Retrieved index', extra={'index_id': index.id, 'index_name': index.name})
+        caches[CHECKS_CACHE].set(key, True, TWELVE_LABS_CHECK_TIMEOUT)
     except APIStatusError as e:
         errors.append(Critical('API Status Error from Twelve Labs', hint=str(e)))
     except Exception as e:
@@ -23,8 +48,49 @@ def check_tl_index_exists(app_configs, **kwargs):
     return errors
 
 
+# noinspection PyUnusedLocal
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Apply SQLITE_PRAGMAS to each new SQLite connection.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for pragma, value in SQLITE_PRAGMAS.items():
+                cursor.execute(f'PRAGMA {pragma} = {value}')
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper that records the number and duration of queries, by statement type, in the metrics.
+    """
+    statement = sql.lstrip().split(' ', 1)[0].upper()
+    if statement not in QUERY_STATEMENTS:
+        statement = 'OTHER'
+    started_at = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    except Exception as ex:
+        metrics.increment('db_query_errors', statement=statement, error=type(ex).__name__)
+        raise
+    finally:
+        metrics.observe('db_query_duration_seconds', perf_counter() - started_at, buckets=QUERY_BUCKETS,
+                        statement=statement)
+
+
+# noinspection PyUnusedLocal
+def instrument_queries(sender, connection, **kwargs):
+    """
+    Add record_query() to each connection. The connection object is reused when Django reconnects, so it may already
+    have it.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
 class CoreConfig(AppConfig):
     name = 'cattube.core'
 
     def ready(self):
         register(check_tl_index_exists)
+        connection_created.connect(configure_sqlite)
+        connection_created.connect(instrument_queries)
@@ -0,0 +1,84 @@
+import asyncio
+import json
+from weakref import WeakKeyDictionary
+
+import httpx
+from twelvelabs import models
+from twelvelabs.constants import API_KEY_HEADER, DEFAULT_TIMEOUT
+from twelvelabs.exceptions import APIConnectionError, APITimeoutError
+from twelvelabs.util import remove_none_values
+
+from cattube.core import metrics
+from cattube.settings import TWELVE_LABS_CLIENT, TWELVE_LABS_ASYNC_MAX_CONNECTIONS
+
+# One client per event loop, since an httpx.AsyncClient's connections belong to the loop that opened them
+_clients = WeakKeyDictionary()
+
+
+class AsyncSearchClient:
+    """
+    Just enough of the Twelve Labs API to search an index without blocking, for async views. It uses the same base URL
+    and API key as TWELVE_LABS_CLIENT, raises the same exceptions, and returns the same models, so results can be used
+    interchangeably.
+    """
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            base_url=TWELVE_LABS_CLIENT.base_url,
+            headers={API_KEY_HEADER: TWELVE_LABS_CLIENT.api_key},
+            timeout=DEFAULT_TIMEOUT,
+            limits=httpx.Limits(max_connections=TWELVE_LABS_ASYNC_MAX_CONNECTIONS,
+                                max_keepalive_connections=TWELVE_LABS_ASYNC_MAX_CONNECTIONS),
+        )
+
+    async def request(self, method, url, **kwargs):
+        """
+        Make a request, converting errors to the Twelve Labs SDK's exceptions.
+        """
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.TimeoutException as e:
+            raise APITimeoutError(request=e.request)
+        except httpx.HTTPError as e:
+            raise APIConnectionError(request=e.request)
+
+        if response.is_error:
+            raise TWELVE_LABS_CLIENT._make_status_error(response)  # noqa
+
+        return json.loads(response.content)
+
+    async def query(self, index_id, options, *, query_text, group_by=None, threshold=None, page_limit=None):
+        """
+        Async equivalent of TWELVE_LABS_CLIENT.search.query() for a text query.
+        """
+        data = {
+            'index_id': index_id,
+            'query_text': query_text,
+            'search_options': options,
+            'group_by': group_by,
+            'threshold': threshold,
+            'page_limit': page_limit,
+        }
+        # The search endpoint only accepts multipart form data
+        with metrics.timer('twelve_labs', 'search.query'):
+            res = await self.request('POST', 'search', data=remove_none_values(data), files={'_': ''})
+        return models.SearchResult(TWELVE_LABS_CLIENT.search, **res)
+
+    async def by_page_token(self, page_token):
+        """
+        Async equivalent of TWELVE_LABS_CLIENT.search.by_page_token().
+        """
+        with metrics.timer('twelve_labs', 'search.by_page_token'):
+            res = await self.request('GET', f'search/{page_token}')
+        return models.SearchResult(TWELVE_LABS_CLIENT.search, **res)
+
+
+def get_async_search_client():
+    """
+    Get the search client for the running event loop, creating it if necessary, so that requests from the same loop
+    share a connection pool.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncSearchClient()
+    return client
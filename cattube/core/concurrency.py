@@ -0,0 +1,97 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, UTC
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep
+
+from twelvelabs import RateLimitError
+
+from cattube.core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter, allowing up to rate calls per second, with bursts of up to capacity calls.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then take it.
+        """
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for the given number of seconds, for example, when the server says to back off.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+            self.tokens = 0
+
+
+def retry_after(ex, default):
+    """
+    Number of seconds the server asked us to wait in the Retry-After header of a 429 response, which may be either a
+    number of seconds or an HTTP date.
+    """
+    value = ex.response.headers.get('Retry-After')
+    if value:
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            try:
+                return max((parsedate_to_datetime(value) - datetime.now(UTC)).total_seconds(), 0)
+            except (TypeError, ValueError):
+                pass
+    return default
+
+
+def call_rate_limited(rate_limiter, max_retries, fn, *args, **kwargs):
+    """
+    Call fn when the rate limiter allows, retrying if we are rate limited anyway. While waiting to retry, the rate
+    limiter is paused, so other threads don't make things worse.
+    """
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except RateLimitError as ex:
+            if attempt >= max_retries:
+                raise
+            delay = retry_after(ex, 2 ** attempt)
+            logger.info('Rate limited', extra={'retry_in': delay})
+            metrics.increment('rate_limited', operation=getattr(fn, '__name__', str(fn)))
+            rate_limiter.pause(delay)
+            attempt += 1
+
+
+def map_concurrently(fn, items, max_workers):
+    """
+    Generator calling fn on each item with up to max_workers threads, yielding (item, result, exception) tuples in
+    the order that the calls complete.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fn, item): item for item in items}
+        for future in as_completed(futures):
+            ex = future.exception()
+            yield futures[future], None if ex else future.result(), ex
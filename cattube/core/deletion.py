@@ -0,0 +1,153 @@
+import logging
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.db.models import F
+from django.utils import timezone
+from twelvelabs import NotFoundError
+
+from cattube.core.concurrency import TokenBucket, call_rate_limited, map_concurrently
+from cattube.core.models import Video, DeletionJob, SyncState, bump_counter
+from cattube.core.search import INDEX_GENERATION
+from cattube.core.sync import VIDEOS_SYNC_STATE
+from cattube.settings import TWELVE_LABS_CLIENT, TWELVE_LABS_INDEX_ID, TWELVE_LABS_RATE_LIMIT, \
+    TWELVE_LABS_MAX_RETRIES, TWELVE_LABS_DELETE_CONCURRENCY, DELETION_BATCH_SIZE, DELETION_RETRY_DELAY, \
+    DELETION_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+
+def delete_from_index(video_id, rate_limiter):
+    """
+    Delete a video from the Twelve Labs index. We don't care if it's already been deleted.
+    """
+    try:
+        call_rate_limited(rate_limiter, TWELVE_LABS_MAX_RETRIES,
+                          TWELVE_LABS_CLIENT.index.video.delete, TWELVE_LABS_INDEX_ID, video_id)
+    except NotFoundError:
+        logger.debug('Not found in index. Carrying on anyway.', extra={'video_id': video_id})
+
+
+def delete_batch(job, videos, rate_limiter):
+    """
+    Delete a batch of videos from B2, if the job says so, then from the Twelve Labs index, then from the database.
+    Videos that could not be deleted stay in the job, since some of their files may already be gone, so that running
+    the job again retries them. Returns the number that could not be deleted.
+    """
+    failed = set()
+
+    # Try deleting from B2 first, with one DeleteObjects request per 1000 files
+    if job.delete_files:
+        names = {}
+        for video in videos:
+            for attr in ['video', 'thumbnail']:
+                name = getattr(video, attr).name
+                if name:
+                    names[name] = video.id
+        for name in default_storage.delete_many(names.keys()):
+            logger.warning('Cannot delete from storage', extra={'file': name})
+            failed.add(names[name])
+
+    # Now delete from Twelve Labs
+    indexed = [video for video in videos if video.video_id and video.id not in failed]
+    for video, _, ex in map_concurrently(lambda v: delete_from_index(v.video_id, rate_limiter),
+                                         indexed,
+                                         TWELVE_LABS_DELETE_CONCURRENCY):
+        if ex:
+            logger.warning('Cannot delete from index', extra={'video_id': video.video_id, 'error': str(ex)})
+            failed.add(video.id)
+
+    # Now delete from the database
+    ids_for_deletion = [video.id for video in videos if video.id not in failed]
+    deleted, rows_count = Video.objects.filter(id__in=ids_for_deletion).delete()
+    logger.debug('Deleted from database', extra={'deleted': deleted, 'rows': rows_count})
+
+    DeletionJob.objects.filter(id=job.id).update(deleted=F('deleted') + len(ids_for_deletion),
+                                                 failed=F('failed') + len(failed))
+    return len(failed)
+
+
+def clear_index(rate_limiter):
+    """
+    Delete every remaining video from the Twelve Labs index. Since deleting videos changes the pages, we keep
+    retrieving the first page until it's empty.
+    """
+    while True:
+        page = TWELVE_LABS_CLIENT.index.video.list_pagination(TWELVE_LABS_INDEX_ID, page_limit=50)
+        if len(page.data) == 0:
+            break
+
+        logger.debug('Deleting videos from index', extra={'count': len(page.data)})
+        failed = [video for video, _, ex in map_concurrently(lambda v: delete_from_index(v.id, rate_limiter),
+                                                              page.data,
+                                                              TWELVE_LABS_DELETE_CONCURRENCY) if ex]
+        if len(failed) == len(page.data):
+            raise Exception(f'Cannot delete any of {len(failed)} videos from index')
+
+
+def retry_due(job, now):
+    """
+    Whether a job that is unfinished, or that finished with failures, should be run again: DELETION_RETRY_DELAY
+    seconds after it last started, doubling after each run.
+    """
+    if job.started_at is None:
+        return True
+    return job.started_at + timedelta(seconds=DELETION_RETRY_DELAY * 2 ** (job.attempts - 1)) < now
+
+
+def give_up(job):
+    """
+    Mark a job as failed, so it isn't run again. Videos that could not be deleted stay in the job.
+    """
+    DeletionJob.objects.filter(id=job.id).update(failed_at=timezone.now())
+    logger.error('Giving up on deletion job', extra={'job': job, 'attempts': job.attempts})
+
+
+def run_deletion_job(job):
+    """
+    Delete the job's videos, DELETION_BATCH_SIZE at a time, in id order, recording progress after each batch. Since
+    videos are removed from the database as they are deleted, a job that was interrupted carries on where it left off
+    when run again, and a job that finished with failures retries them, until it has been run DELETION_MAX_ATTEMPTS
+    times.
+    """
+    logger.info('Running deletion job', extra={'job': job})
+    rate_limiter = TokenBucket(TWELVE_LABS_RATE_LIMIT)
+
+    # Videos that failed before are tried again, so only count this run's failures
+    job.attempts += 1
+    job.started_at = timezone.now()
+    job.failed = 0
+    job.save(update_fields=['attempts', 'started_at', 'failed'])
+    failed = 0
+    last_id = 0
+    try:
+        while True:
+            videos = list(job.videos.filter(id__gt=last_id).order_by('id')[:DELETION_BATCH_SIZE])
+            if len(videos) == 0:
+                break
+            failed += delete_batch(job, videos, rate_limiter)
+            last_id = videos[-1].id
+            # Cached search results may refer to the deleted videos
+            bump_counter(INDEX_GENERATION)
+
+        if job.reset:
+            clear_index(rate_limiter)
+            bump_counter(INDEX_GENERATION)
+            # Pick up the files in the bucket again on the next page view
+            SyncState.objects.filter(name=VIDEOS_SYNC_STATE).update(synced_at=None)
+    except Exception:
+        if job.attempts >= DELETION_MAX_ATTEMPTS:
+            give_up(job)
+        raise
+
+    job.refresh_from_db()
+    job.finished_at = timezone.now()
+    # A job that was given up on while it was still running may have succeeded after all
+    job.failed_at = job.finished_at if failed > 0 and job.attempts >= DELETION_MAX_ATTEMPTS else None
+    job.save(update_fields=['finished_at', 'failed_at'])
+    if job.failed_at:
+        logger.error('Finished deletion job with failures; giving up', extra={'job': job, 'failed': failed})
+    elif failed > 0:
+        logger.warning('Finished deletion job with failures; it will be retried', extra={'job': job, 'failed': failed})
+    else:
+        logger.info('Finished deletion job', extra={'job': job})
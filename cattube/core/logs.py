@@ -0,0 +1,43 @@
+import json
+import logging
+import random
+
+# Attributes that every LogRecord has, so any others were passed in extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', logging.INFO, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class SampleFilter(logging.Filter):
+    """
+    Pass every record at INFO and above, but only a random fraction, rate, of DEBUG records, which mostly come from
+    loops over videos and tasks.
+    """
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Format records as time, level, logger and message, followed by the fields passed in extra as key=value pairs, so
+    that the logs can be searched by video, task etc.
+    """
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def formatMessage(self, record):
+        fields = [f'{key}={format_value(value)}' for key, value in vars(record).items()
+                  if key not in RECORD_ATTRIBUTES]
+        return ' '.join([super().formatMessage(record), *fields])
+
+
+def format_value(value):
+    """
+    Quote strings that contain spaces, quotes or equals signs, so the pairs can be split up again.
+    """
+    value = str(value)
+    if value == '' or any(c in value for c in ' "=\n'):
+        return json.dumps(value)
+    return value
@@ -0,0 +1,89 @@
+from time import monotonic
+
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from cattube.core.models import SyncState, Video
+from cattube.core.sync import add_files, save_progress, finish_sync
+from cattube.core.tasks import do_video_indexing, prepare_indexing
+from cattube.settings import VIDEOS_PATH, INGEST_PAGE_SIZE, INGEST_BATCH_SIZE, INGEST_INDEX_RATE, \
+    TWELVE_LABS_CREATE_BATCH_SIZE
+
+# Name of the SyncState row that records how far the ingest has got. It's separate from the list page's, so the two
+# scans don't move each other's checkpoint.
+INGEST_SYNC_STATE = 'ingest'
+
+
+class Command(BaseCommand):
+    """
+    Register the videos already in the bucket, a page of the listing at a time, optionally scheduling them for
+    indexing. Progress is saved after each page, so an interrupted ingest carries on where it left off when run again.
+    Example usage::
+
+    python manage.py ingest_bucket --user admin --index --index-rate 2
+    """
+    help = "Add the videos already in the bucket to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True, help="Username that will own the new videos")
+        parser.add_argument('--index', action='store_true',
+                            help="Schedule videos that have not been indexed for indexing")
+        parser.add_argument('--index-rate', type=float, default=INGEST_INDEX_RATE,
+                            help="Videos per second to schedule for indexing")
+        parser.add_argument('--page-size', type=int, default=INGEST_PAGE_SIZE,
+                            help="Number of files to list at a time")
+        parser.add_argument('--restart', action='store_true',
+                            help="Start from the beginning of the bucket rather than the last checkpoint")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f'No such user {options["user"]}')
+        if options['index_rate'] <= 0:
+            raise CommandError('--index-rate must be positive')
+
+        state, _ = SyncState.objects.get_or_create(name=INGEST_SYNC_STATE)
+        if options['restart']:
+            state.last_key = ''
+        if state.last_key:
+            self.stdout.write(f'Resuming after {state.last_key}')
+
+        started_at = monotonic()
+        # When the next batch of videos to index should start
+        index_at = started_at
+        listed = added = scheduled = 0
+        for files in default_storage.list_files(VIDEOS_PATH, start_after=state.last_key,
+                                                page_size=options['page_size']):
+            listed += len(files)
+            added += len(add_files(files, user, batch_size=INGEST_BATCH_SIZE))
+
+            if options['index']:
+                # Includes videos added by an earlier run that was interrupted before it scheduled them
+                videos = Video.objects.filter(video__in=[name for name, _ in files], status='',
+                                              deletion_job__isnull=True).only('id', 'video')
+                video_dicts = prepare_indexing(videos)
+                for i in range(0, len(video_dicts), TWELVE_LABS_CREATE_BATCH_SIZE):
+                    batch = video_dicts[i:i + TWELVE_LABS_CREATE_BATCH_SIZE]
+                    now = monotonic()
+                    index_at = max(index_at, now)
+                    do_video_indexing.schedule(args=(batch,), delay=index_at - now)
+                    index_at += len(batch) / options['index_rate']
+                scheduled += len(video_dicts)
+
+            # The checkpoint only moves once the page is done
+            save_progress(state, files)
+
+            elapsed = monotonic() - started_at
+            self.stdout.write(f'{listed} files listed, {added} videos added, {scheduled} scheduled for indexing; '
+                              f'{listed / elapsed:.0f} files/s')
+
+        finish_sync(state)
+
+        elapsed = monotonic() - started_at
+        self.stdout.write(f'Added {added} of {listed} files in {elapsed:.1f} seconds '
+                          f'({listed / elapsed if elapsed else 0:.0f} files/s)')
+        if scheduled:
+            self.stdout.write(f'Scheduled {scheduled} videos for indexing over the next '
+                              f'{index_at - monotonic():.0f} seconds')
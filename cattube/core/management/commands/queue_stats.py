@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from cattube.core.queues import queue_depths
+
+
+class Command(BaseCommand):
+    """
+    Show how many tasks are waiting in each queue. Example usage::
+
+    python manage.py queue_stats
+    """
+    help = "Show the depth of each task queue"
+
+    def handle(self, *args, **options):
+        for name, depths in queue_depths().items():
+            self.stdout.write(f'{name}: {depths["pending"]} pending, {depths["scheduled"]} scheduled')
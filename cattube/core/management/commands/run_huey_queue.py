@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.utils.module_loading import autodiscover_modules
+from huey.consumer_options import ConsumerConfig
+from huey.contrib.djhuey.management.commands import run_huey
+
+from cattube.core.queues import get_queue
+from cattube.settings import HUEY_QUEUES
+
+
+class Command(run_huey.Command):
+    """
+    Consumer for one of the queues in HUEY_QUEUES. Example usage::
+
+    python manage.py run_huey_queue polling
+    """
+    help = "Run the consumer for one of the named queues"
+
+    def add_arguments(self, parser):
+        parser.add_argument('queue', choices=list(HUEY_QUEUES))
+        super().add_arguments(parser)
+
+    def handle(self, *args, **options):
+        name = options.pop('queue')
+
+        # Start with the default queue's consumer options, then the named queue's, then the command line
+        consumer_options = {**settings.HUEY.get('consumer', {}), **HUEY_QUEUES[name]}
+        for key, value in options.items():
+            if value is not None:
+                consumer_options[key] = value
+        consumer_options.setdefault('verbose', consumer_options.pop('huey_verbose', None))
+
+        if not options.get('disable_autoload'):
+            autodiscover_modules("tasks")
+
+        config = ConsumerConfig(**consumer_options)
+        config.validate()
+        config.setup_logger()
+
+        get_queue(name).create_consumer(**config.values).run()
@@ -0,0 +1,292 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter, time
+
+from cattube.settings import METRICS_DIR, METRICS_FLUSH_INTERVAL, LATENCY_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+# Prefix for the names of exported metrics
+PREFIX = 'cattube_'
+
+# File in METRICS_DIR holding the metrics of processes that have exited, added together
+EXITED_FILE = 'exited.json'
+
+# In-process counters, keyed by (name, labels), where labels is a sorted tuple of (label, value) tuples
+_counters = defaultdict(float)
+# In-process histograms, keyed by (name, labels). Each value is [bucket bounds, count per bucket, sum], where the last
+# count is for values above the highest bound.
+_histograms = {}
+_lock = threading.Lock()
+_flushed_at = time()
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """
+    Add value to the named counter.
+    """
+    with _lock:
+        _counters[(name, label_key(labels))] += value
+    maybe_flush()
+
+
+def get_counter(name, **labels):
+    return _counters[(name, label_key(labels))]
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Add value to the named histogram.
+    """
+    key = (name, label_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        histogram[1][i] += 1
+        histogram[2] += value
+    maybe_flush()
+
+
+def record_call(service, operation, seconds, error=None):
+    """
+    Record the duration of a call to an external service, and whether it failed.
+    """
+    observe('external_request_duration_seconds', seconds, service=service, operation=operation)
+    if error:
+        increment('external_request_errors', service=service, operation=operation, error=error)
+
+
+@contextmanager
+def timer(service, operation):
+    """
+    Record the duration of the block as a call to an external service, counting an exception as an error.
+    """
+    started_at = perf_counter()
+    try:
+        yield
+    except Exception as ex:
+        record_call(service, operation, perf_counter() - started_at, type(ex).__name__)
+        raise
+    record_call(service, operation, perf_counter() - started_at)
+
+
+class Instrumented:
+    """
+    Proxy for an API client that records each method call with timer(), naming the operation after the method.
+    Attributes that are instances of one of the resources classes are proxied in turn, so, for example, a call to
+    client.index.video.delete() is recorded as index.video.delete. Private attributes are passed through as they are.
+    """
+    def __init__(self, target, service, resources=(), prefix=''):
+        self._target = target
+        self._service = service
+        self._resources = resources
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name.startswith('_'):
+            return value
+        if isinstance(value, self._resources):
+            return Instrumented(value, self._service, self._resources, f'{self._prefix}{name}.')
+        if callable(value) and not isinstance(value, type):
+            operation = f'{self._prefix}{name}'
+
+            @wraps(value)
+            def inner(*args, **kwargs):
+                with timer(self._service, operation):
+                    return value(*args, **kwargs)
+            return inner
+        return value
+
+
+def instrument(target, service, resources=()):
+    return Instrumented(target, service, resources)
+
+
+def snapshot():
+    """
+    Copy of this process's metrics that can be saved as JSON.
+    """
+    with _lock:
+        return {
+            'counters': [[name, labels, value] for (name, labels), value in _counters.items()],
+            'histograms': [[name, labels, list(buckets), list(counts), total]
+                           for (name, labels), (buckets, counts, total) in _histograms.items()],
+        }
+
+
+def flush():
+    """
+    Save this process's metrics to a file in METRICS_DIR, so that export() in another process can include them.
+    """
+    global _flushed_at
+    _flushed_at = time()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    temp_path = f'{path}.{threading.get_ident()}'
+    with open(temp_path, 'w') as f:
+        json.dump(snapshot(), f)
+    # Readers never see a partly written file
+    os.replace(temp_path, path)
+
+
+def maybe_flush():
+    """
+    Save this process's metrics if it's been METRICS_FLUSH_INTERVAL seconds since they were last saved. Short-lived
+    processes, such as most management commands, exit before they save anything.
+    """
+    if time() - _flushed_at > METRICS_FLUSH_INTERVAL:
+        try:
+            flush()
+        except OSError as ex:
+            logger.warning('Cannot save metrics', extra={'path': METRICS_DIR, 'error': str(ex)})
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It belongs to another user
+        return True
+    return True
+
+
+def prune_exited():
+    """
+    Add the metrics that processes that have exited saved into EXITED_FILE, and remove their own files, so METRICS_DIR
+    doesn't grow with every process that has ever run, and counters don't go backwards. A lock on METRICS_DIR stops two
+    processes adding the same metrics in.
+    """
+    try:
+        lock = os.open(METRICS_DIR, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        exited = [filename for filename in os.listdir(METRICS_DIR)
+                  if filename.endswith('.json') and filename[:-5].isdigit() and not is_running(int(filename[:-5]))]
+        if len(exited) == 0:
+            return
+        snapshots = []
+        for filename in [EXITED_FILE, *exited]:
+            try:
+                with open(os.path.join(METRICS_DIR, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        counters, histograms = merge(snapshots)
+        path = os.path.join(METRICS_DIR, EXITED_FILE)
+        with open(f'{path}.{os.getpid()}', 'w') as f:
+            json.dump({
+                'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels, *histogram] for (name, labels), histogram in histograms.items()],
+            }, f)
+        os.replace(f'{path}.{os.getpid()}', path)
+        for filename in exited:
+            os.remove(os.path.join(METRICS_DIR, filename))
+        logger.debug('Pruned metrics of exited processes', extra={'count': len(exited)})
+    finally:
+        os.close(lock)
+
+
+def other_snapshots():
+    """
+    The metrics that other processes have saved, including those that have exited, so counters don't go backwards.
+    """
+    own_file = f'{os.getpid()}.json'
+    try:
+        filenames = [filename for filename in os.listdir(METRICS_DIR)
+                     if filename.endswith('.json') and filename != own_file]
+    except FileNotFoundError:
+        return
+    for filename in filenames:
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            # The process may have just replaced it
+            continue
+
+
+def format_labels(labels, **extra):
+    labels = [*labels, *extra.items()]
+    if len(labels) == 0:
+        return ''
+    escaped = [(key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+               for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def merge(snapshots):
+    """
+    Add snapshots together, giving counters and histograms keyed by (name, labels), like _counters and _histograms.
+    """
+    counters = defaultdict(float)
+    histograms = {}
+    for data in snapshots:
+        for name, labels, value in data['counters']:
+            counters[(name, tuple(map(tuple, labels)))] += value
+        for name, labels, buckets, counts, total in data['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            if key not in histograms:
+                histograms[key] = [buckets, counts, total]
+            elif histograms[key][0] == buckets:
+                histograms[key][1] = [a + b for a, b in zip(histograms[key][1], counts)]
+                histograms[key][2] += total
+    return counters, histograms
+
+
+def export(gauges=()):
+    """
+    The metrics of every process, added together, in Prometheus text format, with gauges, a list of (name, labels
+    dict, value) tuples, measured at the time of the export.
+    """
+    try:
+        prune_exited()
+    except OSError as ex:
+        logger.warning('Cannot prune metrics', extra={'path': METRICS_DIR, 'error': str(ex)})
+    counters, histograms = merge([snapshot(), *other_snapshots()])
+
+    lines = []
+    typed = set()
+
+    def add_type(name, metric_type):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} {metric_type}')
+
+    for (name, labels), value in sorted(counters.items()):
+        name = PREFIX + (name if name.endswith('_total') else f'{name}_total')
+        add_type(name, 'counter')
+        lines.append(f'{name}{format_labels(labels)} {float(value)!r}')
+    for (name, labels), (buckets, counts, total) in sorted(histograms.items()):
+        name = PREFIX + name
+        add_type(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip([*buckets, '+Inf'], counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {float(total)!r}')
+        lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+        name = PREFIX + name
+        add_type(name, 'gauge')
+        lines.append(f'{name}{format_labels(label_key(labels))} {float(value)!r}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 16:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_remove_video_logo_remove_video_text_in_video_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('last_key', models.CharField(default='', max_length=1024)),
+                ('last_modified', models.DateTimeField(null=True)),
+                ('synced_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 16:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_syncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='next_poll_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='poll_interval',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='task_id',
+            field=models.CharField(default='', max_length=32),
+        ),
+    ]
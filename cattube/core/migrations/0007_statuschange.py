@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-18 16:09
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_video_task_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatusChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(default='', max_length=16)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('video', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_changes', to='core.video')),
+            ],
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 5.2 on 2026-10-18 16:18
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def clear_duplicate_ids(apps, schema_editor):
+    """
+    Clear duplicated Twelve Labs video ids and Transloadit assembly ids, so that the unique constraints can be added.
+    For a video id, keep it on the video that is ready, then the newest; the others go back to waiting to be indexed.
+    For an assembly id, keep it on the newest video; it is only needed while the upload is in progress.
+    """
+    Video = apps.get_model('core', 'Video')
+    for field, keep_key, cleared in [
+        ('video_id', lambda video: (video.status == 'Ready', video.id), {'video_id': '', 'status': ''}),
+        ('assembly_id', lambda video: video.id, {'assembly_id': ''}),
+    ]:
+        videos = Video.objects.exclude(**{field: ''})
+        duplicated = videos.values(field).annotate(count=models.Count('id')).filter(count__gt=1).values_list(field,
+                                                                                                           flat=True)
+        for value in duplicated:
+            keep = max(videos.filter(**{field: value}), key=keep_key)
+            videos.filter(**{field: value}).exclude(id=keep.id).update(**cleared)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_deletionjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='video',
+            name='assembly_id',
+            field=models.CharField(db_index=True, default='', max_length=256),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='deletion_job',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='videos', to='core.deletionjob'),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='next_poll_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='uploaded_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='video',
+            field=models.FileField(db_index=True, null=True, upload_to=''),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='video_id',
+            field=models.CharField(db_index=True, default='', max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['status', 'uploaded_at'], name='video_status_uploaded_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['deletion_job', 'uploaded_at'], name='video_deletion_uploaded_at_idx'),
+        ),
+        migrations.RunPython(clear_duplicate_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='video',
+            constraint=models.UniqueConstraint(condition=models.Q(('video_id', ''), _negated=True), fields=('video_id',), name='unique_video_id'),
+        ),
+        migrations.AddConstraint(
+            model_name='video',
+            constraint=models.UniqueConstraint(condition=models.Q(('assembly_id', ''), _negated=True), fields=('assembly_id',), name='unique_assembly_id'),
+        ),
+    ]
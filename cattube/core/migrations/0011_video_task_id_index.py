@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_video_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='video',
+            name='task_id',
+            field=models.CharField(db_index=True, default='', max_length=32),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-18 16:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def delete_duplicate_videos(apps, schema_editor):
+    """
+    Concurrent scans of the bucket could add the same file more than once. Keep the video that has got furthest for
+    each file: one that is in the index, then one that is ready, then the newest.
+    """
+    Video = apps.get_model('core', 'Video')
+    videos = Video.objects.filter(video__isnull=False).exclude(video='')
+    duplicated = videos.values('video').annotate(count=models.Count('id')).filter(count__gt=1).values_list('video',
+                                                                                                          flat=True)
+    for name in duplicated:
+        duplicates = list(videos.filter(video=name))
+        keep = max(duplicates, key=lambda video: (video.video_id != '', video.status == 'Ready', video.id))
+        videos.filter(video=name).exclude(id=keep.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_video_task_id_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_videos, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='video',
+            constraint=models.UniqueConstraint(condition=models.Q(('video', ''), _negated=True), fields=('video',), name='unique_video'),
+        ),
+    ]
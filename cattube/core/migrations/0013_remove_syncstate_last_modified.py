@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 17:25
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_video_unique_file'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='syncstate',
+            name='last_modified',
+        ),
+    ]
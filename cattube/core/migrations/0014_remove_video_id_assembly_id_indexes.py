@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_remove_syncstate_last_modified'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='video',
+            name='assembly_id',
+            field=models.CharField(default='', max_length=256),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='video_id',
+            field=models.CharField(default='', max_length=32),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 17:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_remove_video_id_assembly_id_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deletionjob',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='deletionjob',
+            name='failed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='deletionjob',
+            name='started_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,26 +1,54 @@
-from pathlib import Path
+import logging
+from collections import defaultdict
 
 from django.contrib.auth.models import User
-from django.core.files.storage import default_storage
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 
+from cattube.core import metrics
 from cattube.core.utils import url_path_join
-from cattube.settings import VIDEOS_PATH
+from cattube.settings import VIDEOS_PATH, STAGE_BUCKETS
+
+logger = logging.getLogger(__name__)
 
 
 class Video(models.Model):
     title = models.CharField(max_length=256)
     assembly_id = models.CharField(max_length=256, default='')
-    uploaded_at = models.DateTimeField(default=timezone.now)
-    video = models.FileField(null=True)
+    uploaded_at = models.DateTimeField(default=timezone.now, db_index=True)
+    video = models.FileField(null=True, db_index=True)
     thumbnail = models.FileField(null=True)
     status = models.CharField(max_length=16, default='')
     video_id = models.CharField(max_length=32, default='')
+    # Twelve Labs indexing task, and when we should next retrieve its status; next_poll_at is null when not indexing
+    task_id = models.CharField(max_length=32, default='', db_index=True)
+    poll_interval = models.FloatField(default=0)
+    next_poll_at = models.DateTimeField(null=True, db_index=True)
     user = models.ForeignKey(User, related_name='videos', on_delete=models.CASCADE)
+    # Set while the video is waiting to be deleted. Indexed by video_deletion_uploaded_at_idx, below.
+    deletion_job = models.ForeignKey('DeletionJob', related_name='videos', null=True, on_delete=models.SET_NULL,
+                                     db_index=False)
 
     ordering = ["-uploaded_at"]
 
+    class Meta:
+        indexes = [
+            # Filtering on status, then ordering by upload time
+            models.Index(fields=['status', 'uploaded_at'], name='video_status_uploaded_at_idx'),
+            # The list page shows videos that are not waiting to be deleted, newest first
+            models.Index(fields=['deletion_job', 'uploaded_at'], name='video_deletion_uploaded_at_idx'),
+        ]
+        constraints = [
+            # Both are empty until the video has been sent to Twelve Labs or Transloadit respectively. These are
+            # the only indexes on the fields, so lookups repeat the condition, with exclude(video_id='') or
+            # exclude(assembly_id=''), since SQLite doesn't use a partial index unless the query does.
+            models.UniqueConstraint(fields=['video_id'], condition=~models.Q(video_id=''), name='unique_video_id'),
+            models.UniqueConstraint(fields=['assembly_id'], condition=~models.Q(assembly_id=''), name='unique_assembly_id'),
+            # Each file in the bucket is one video, so scans of the bucket can't add it twice. The file is null
+            # until Transloadit has finished with an upload.
+            models.UniqueConstraint(fields=['video'], condition=~models.Q(video=''), name='unique_video'),
+        ]
+
     def __str__(self):
         return f'"{self.title}", uploaded at {self.uploaded_at}, assembly_id {self.assembly_id}, original {self.video}, user {self.user.username}'
 
@@ -29,9 +57,31 @@ class Video(models.Model):
         return self.status in ("Ready", "Failed")
 
     def update_from_assembly(self, assembly):
-        self.video = url_path_join(VIDEOS_PATH, assembly['results'][':original'][0]['name'])
-        print(f'Saving {self}')
-        self.save()
+        """
+        Set the video's file from its finished Transloadit assembly. A scan of the bucket may have found the file before
+        we did, or the upload replaced an existing file. Either way, the existing video is kept, since it may already be
+        indexed, and takes over this upload's title, owner and assembly, and this video is deleted. Returns the video
+        that now has the file.
+        """
+        name = url_path_join(VIDEOS_PATH, assembly['results'][':original'][0]['name'])
+        with transaction.atomic():
+            video = Video.objects.filter(video=name).exclude(id=self.id).first()
+            if video is None:
+                self.video = name
+                logger.info('Saving video', extra={'video': self})
+                self.save()
+                video = self
+            else:
+                logger.info('Reusing existing video for upload', extra={'video_pk': video.id, 'file': name,
+                                                                         'assembly_id': self.assembly_id})
+                # The assembly id is unique, so this video has to go first
+                self.delete()
+                video.title = self.title
+                video.user = self.user
+                video.assembly_id = self.assembly_id
+                video.save(update_fields=['title', 'user', 'assembly_id'])
+        record_status_changes([video])
+        return video
 
 
 class Notification(models.Model):
@@ -39,6 +89,108 @@ class Notification(models.Model):
     signature = models.CharField(max_length=40)
 
 
+class DeletionJob(models.Model):
+    """
+    A background job to delete a set of videos, recording its progress. delete_files says whether to delete the
+    videos' files from B2, and reset says whether to clear the rest of the Twelve Labs index afterwards. attempts is
+    the number of times the job has been run, and failed_at is set when it's given up on, after DELETION_MAX_ATTEMPTS
+    runs, leaving the videos that could not be deleted in the job.
+    """
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    failed_at = models.DateTimeField(null=True)
+    attempts = models.IntegerField(default=0)
+    delete_files = models.BooleanField(default=True)
+    reset = models.BooleanField(default=False)
+    total = models.IntegerField(default=0)
+    deleted = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'deletion job {self.id}, created at {self.created_at}, deleted {self.deleted} of {self.total}, {self.failed} failed'
+
+
+class StatusChange(models.Model):
+    """
+    Journal of changes to videos, so clients can wait for the changes since the last one they saw, rather than
+    repeatedly fetching the status of every video they are showing. The id serves as the clients' cursor.
+    """
+    video = models.ForeignKey(Video, related_name='status_changes', on_delete=models.CASCADE)
+    status = models.CharField(max_length=16, default='')
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+def record_status_changes(videos):
+    """
+    Add an entry to the status change journal for each of the videos.
+    """
+    StatusChange.objects.bulk_create([StatusChange(video=video, status=video.status) for video in videos])
+    record_stage_durations([video for video in videos if video.done])
+
+
+def record_stage_durations(videos):
+    """
+    Record how long each of the videos, which have just finished indexing, spent in each stage, from the status change
+    journal: uploading, then waiting for indexing, then each of the indexing task's statuses.
+    """
+    if len(videos) == 0:
+        return
+    journals = defaultdict(list)
+    for video_id, status, created_at in StatusChange.objects.filter(video__in=videos).order_by('id') \
+            .values_list('video_id', 'status', 'created_at'):
+        journals[video_id].append((status, created_at))
+
+    for video in videos:
+        changes = journals[video.id]
+        # A video that was already done, for example one whose thumbnail has just arrived, has been counted
+        if len(changes) == 0 or any(status in ('Ready', 'Failed') for status, _ in changes[:-1]):
+            continue
+        # Only the first of a run of the same status starts a stage
+        journal = [change for i, change in enumerate(changes) if i == 0 or changes[i - 1][0] != change[0]]
+        if journal[0][0] == '':
+            metrics.observe('video_stage_duration_seconds', (journal[0][1] - video.uploaded_at).total_seconds(),
+                            buckets=STAGE_BUCKETS, stage='upload')
+        for (status, started_at), (_, finished_at) in zip(journal, journal[1:]):
+            metrics.observe('video_stage_duration_seconds', (finished_at - started_at).total_seconds(),
+                            buckets=STAGE_BUCKETS, stage=status.lower() or 'waiting')
+        metrics.increment('videos_indexed', status=video.status.lower())
+
+
+class SyncState(models.Model):
+    """
+    Persisted cursor for incremental bucket scans. last_key is the last file name processed, so an interrupted scan
+    can resume where it left off, and synced_at is when the last scan started or finished.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    last_key = models.CharField(max_length=1024, default='')
+    synced_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f'"{self.name}", last key {self.last_key}, synced at {self.synced_at}'
+
+
+class Counter(models.Model):
+    """
+    Named counter shared between the web app and the Huey tasks.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    value = models.BigIntegerField(default=0)
+
+
+def get_counter(name):
+    return Counter.objects.filter(name=name).values_list('value', flat=True).first() or 0
+
+
+def bump_counter(name):
+    """
+    Atomically increment the named counter.
+    """
+    if Counter.objects.filter(name=name).update(value=models.F('value') + 1) == 0:
+        Counter.objects.get_or_create(name=name)
+        Counter.objects.filter(name=name).update(value=models.F('value') + 1)
+
+
 class GroupField(models.Field):
     """
     Holder for the search result's group
@@ -56,22 +208,3 @@ class SearchResult(models.Model):
     clip_count = models.IntegerField(default=0)
     clips = models.CharField(max_length=10240, default='')
 
-
-def add_new_files(user):
-    """
-    Helper function to list files in the default storage, adding them to the database if they do not already exist.
-    """
-    if user.is_authenticated:
-        directories, files = default_storage.listdir(f'{VIDEOS_PATH}')
-        videos = Video.objects.all()
-        new_videos = []
-        for file in files:
-            path_to_file = url_path_join(VIDEOS_PATH, file)
-            if len(videos.filter(video__exact=path_to_file)) == 0:
-                new_videos.append(Video(
-                    video=path_to_file,
-                    title=Path(file).stem,
-                    user=user,
-                   uploaded_at=default_storage.get_modified_time(path_to_file)))
-        if len(new_videos) > 0:
-            Video.objects.bulk_create(new_videos)
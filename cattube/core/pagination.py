@@ -0,0 +1,110 @@
+from datetime import datetime, timezone
+
+from django.core.cache import cache
+from django.core.paginator import InvalidPage
+from django.utils.functional import cached_property
+
+# Cursors identify a video by its upload time, to the microsecond, and its id, which breaks ties
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def make_cursor(video):
+    """
+    Encode the video's position in the list as a string that can go in a URL.
+    """
+    return f'{video.uploaded_at.astimezone(timezone.utc):{CURSOR_FORMAT}}.{video.id}'
+
+
+def parse_cursor(cursor):
+    """
+    Decode a cursor created by make_cursor() to an (uploaded_at, id) tuple.
+    """
+    try:
+        uploaded_at, video_id = cursor.split('.')
+        return datetime.strptime(uploaded_at, CURSOR_FORMAT).replace(tzinfo=timezone.utc), int(video_id)
+    except ValueError:
+        raise InvalidPage(f'Invalid cursor {cursor}')
+
+
+class KeysetPaginator:
+    """
+    Pages through videos newest first, like Paginator, but each page starts from the position of the last video on the
+    page before, rather than an offset, so the database seeks straight to it using the (uploaded_at) index, however
+    deep the page is. The trade-off is that pages aren't numbered: there are only first, previous, next and last links.
+
+    Counting the videos means reading the whole index, so the count can be cached for count_timeout seconds.
+    """
+    def __init__(self, queryset, per_page, count_key=None, count_timeout=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.count_key = count_key
+        self.count_timeout = count_timeout
+
+    @cached_property
+    def count(self):
+        if self.count_key and self.count_timeout:
+            return cache.get_or_set(self.count_key, self.queryset.count, self.count_timeout)
+        return self.queryset.count()
+
+    def page(self, after=None, before=None, last=False):
+        """
+        Get the page of videos after the after cursor, before the before cursor, the last page, or the first page.
+        """
+        queryset = self.queryset
+        if after:
+            uploaded_at, video_id = parse_cursor(after)
+            # Equivalent to (uploaded_at, id) < (cursor), in a form that SQLite can use the index for
+            queryset = (queryset.filter(uploaded_at__lte=uploaded_at)
+                        .exclude(uploaded_at=uploaded_at, id__gte=video_id))
+        elif before:
+            uploaded_at, video_id = parse_cursor(before)
+            queryset = (queryset.filter(uploaded_at__gte=uploaded_at)
+                        .exclude(uploaded_at=uploaded_at, id__lte=video_id))
+
+        # Pages before the cursor, and the last page, are read in reverse, from the oldest video up. Fetching one more
+        # video than fits on the page shows whether there is another page beyond it.
+        reverse = bool(before) or last
+        ordering = ['uploaded_at', 'id'] if reverse else ['-uploaded_at', '-id']
+        videos = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        more = len(videos) > self.per_page
+        videos = videos[:self.per_page]
+
+        if reverse:
+            if before and not more:
+                # Reached the start of the list, so show a full first page, rather than whatever is left of it
+                return self.page()
+            videos.reverse()
+            return KeysetPage(videos, self, has_previous=more, has_next=not last)
+        return KeysetPage(videos, self, has_previous=bool(after), has_next=more)
+
+
+class KeysetPage:
+    """
+    A page from KeysetPaginator, with enough of Page's interface for ListView and the templates.
+    """
+    def __init__(self, object_list, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_previous(self):
+        return self._has_previous and len(self.object_list) > 0
+
+    def has_next(self):
+        return self._has_next and len(self.object_list) > 0
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def previous_cursor(self):
+        return make_cursor(self.object_list[0])
+
+    def next_cursor(self):
+        return make_cursor(self.object_list[-1])
@@ -0,0 +1,119 @@
+import logging
+from datetime import timezone
+from functools import cache, wraps
+from time import perf_counter, time
+
+from django.conf import settings
+from huey import signals
+from huey.contrib import djhuey
+
+from cattube.core import metrics
+from cattube.settings import HUEY_QUEUES, HUEY_QUEUE_OPTIONS, QUEUE_LATENCY_WARNING
+
+logger = logging.getLogger(__name__)
+
+# Keyword argument that carries the time a task was enqueued through to the worker
+ENQUEUED_AT = '_enqueued_at'
+
+# Name used for the default queue, the one that 'manage.py run_huey' consumes
+DEFAULT_QUEUE = 'default'
+
+
+@cache
+def get_queue(name=DEFAULT_QUEUE):
+    """
+    Get the Huey instance for the named queue. Each queue in HUEY_QUEUES has the same configuration as the default
+    queue, but its own name, so its tasks are stored separately and it needs its own consumer. Queues that aren't in
+    HUEY_QUEUES are the default queue, so their tasks still run when there is no consumer for them.
+    """
+    if name != DEFAULT_QUEUE and name not in HUEY_QUEUES:
+        if name not in HUEY_QUEUE_OPTIONS:
+            raise ValueError(f'Unknown queue {name}')
+        return get_queue(DEFAULT_QUEUE)
+
+    if name == DEFAULT_QUEUE:
+        huey = djhuey.HUEY
+    else:
+        config = {key: value for key, value in settings.HUEY.items() if key not in ['name', 'huey_class', 'consumer']}
+        config.setdefault('immediate', djhuey.HUEY.immediate)
+        huey = djhuey.get_backend(settings.HUEY['huey_class'])(f'{djhuey.HUEY.name}-{name}', **config)
+
+    huey.signal(signals.SIGNAL_ENQUEUED)(record_enqueue)
+    huey.signal(signals.SIGNAL_EXECUTING)(lambda signal, task: record_latency(name, task))
+    return huey
+
+
+def record_enqueue(_, task):
+    """
+    Stamp tasks that were created by db_task() or db_periodic_task() with the time they were enqueued.
+    """
+    if getattr(task, 'timed', False):
+        task.kwargs[ENQUEUED_AT] = time()
+
+
+def record_latency(name, task):
+    """
+    Record how long the task waited in the queue before a worker picked it up.
+    """
+    enqueued_at = task.kwargs.get(ENQUEUED_AT)
+    if enqueued_at is None:
+        return
+    # A scheduled task only starts waiting at its eta, which Huey keeps as a naive datetime, in UTC by default
+    if task.eta is not None:
+        eta = task.eta.replace(tzinfo=timezone.utc) if get_queue(name).utc else task.eta
+        enqueued_at = max(enqueued_at, eta.timestamp())
+    latency = time() - enqueued_at
+    metrics.observe('queue_latency_seconds', latency, queue=name)
+    if latency > QUEUE_LATENCY_WARNING:
+        logger.warning('Task waited in queue', extra={'task': task, 'queue': name, 'latency': round(latency, 1)})
+
+
+def timed(fn):
+    """
+    Discard the enqueue time before calling the task function, and record how long the task takes, and whether it
+    fails.
+    """
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        kwargs.pop(ENQUEUED_AT, None)
+        started_at = perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as ex:
+            metrics.increment('task_errors', task=fn.__name__, error=type(ex).__name__)
+            raise
+        finally:
+            metrics.observe('task_duration_seconds', perf_counter() - started_at, task=fn.__name__)
+    return inner
+
+
+def db_task(*args, queue=DEFAULT_QUEUE, **kwargs):
+    """
+    Like djhuey.db_task(), but on the named queue, and recording queue latency.
+    """
+    def decorator(fn):
+        ret = get_queue(queue).task(*args, **kwargs)(djhuey.close_db(timed(fn)))
+        ret.task_class.timed = True
+        ret.call_local = fn
+        return ret
+    return decorator
+
+
+def db_periodic_task(*args, queue=DEFAULT_QUEUE, **kwargs):
+    """
+    Like djhuey.db_periodic_task(), but on the named queue, and recording queue latency.
+    """
+    def decorator(fn):
+        ret = get_queue(queue).periodic_task(*args, **kwargs)(djhuey.close_db(timed(fn)))
+        ret.task_class.timed = True
+        ret.call_local = fn
+        return ret
+    return decorator
+
+
+def queue_depths():
+    """
+    Number of tasks waiting in each queue, and the number scheduled to run later.
+    """
+    return {name: {'pending': get_queue(name).pending_count(), 'scheduled': get_queue(name).scheduled_count()}
+            for name in [DEFAULT_QUEUE, *HUEY_QUEUES]}
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import logging
+from datetime import datetime, UTC
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from cattube.core import metrics
+from cattube.core.async_client import get_async_search_client
+from cattube.core.models import Video, SearchResult, get_counter
+from cattube.settings import TWELVE_LABS_CLIENT, TWELVE_LABS_INDEX_ID, SEARCH_CACHE, SEARCH_PAGE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Name of the counter that changes whenever the contents of the index change
+INDEX_GENERATION = 'index_generation'
+
+SEARCH_OPTIONS = {
+    'options': ['visual', 'audio'],
+    'group_by': 'video',
+    'threshold': 'high',
+}
+
+# The parts of each clip that the result page shows; the rest of what Twelve Labs returns isn't kept
+CLIP_FIELDS = {'start', 'end', 'confidence', 'metadata'}
+
+
+def normalize_query(query):
+    """
+    Queries that differ only in case and whitespace get the same results, so they can share a cache entry.
+    """
+    return ' '.join(query.split()).casefold()
+
+
+def get_search_id(query, generation):
+    """
+    Identifies a search, so that later requests can find its results in the cache.
+    """
+    key = json.dumps([normalize_query(query), SEARCH_OPTIONS, generation], sort_keys=True)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def page_cache_key(search_id, number):
+    return f'search_{search_id}_page_{number}'
+
+
+def get_clips(search_id, number, video_id):
+    """
+    The clips for a video on a page of a search's results, as a list of dicts, or None if the page has expired from
+    the cache.
+    """
+    page = caches[SEARCH_CACHE].get(page_cache_key(search_id, number))
+    if page is None:
+        return None
+    return dict(page['groups']).get(video_id)
+
+
+def parse_expiry(page_expires_at):
+    """
+    Number of seconds until a page token expires, given its expiry time as an ISO 8601 string.
+    """
+    try:
+        return (datetime.fromisoformat(page_expires_at.replace('Z', '+00:00')) - datetime.now(UTC)).total_seconds()
+    except (AttributeError, ValueError):
+        return None
+
+
+def page_timeout(results):
+    """
+    How long to cache a page of results for: as long as its next page token is good. Returns 0 if the page has
+    already expired, so there is no point caching it.
+    """
+    timeout = parse_expiry(results.page_info.page_expires_at)
+    if timeout is None:
+        return DEFAULT_TIMEOUT
+    return max(timeout, 0)
+
+
+class LazySearchResults:
+    """
+    Search results that are retrieved from Twelve Labs a page at a time, as the paginator asks for them, rather than
+    all up front. Each page of results, including the token for the next page, is cached against the index
+    generation, so they are discarded as soon as videos are indexed or deleted. The result page retrieves a video's
+    clips from the cached page with get_clips().
+    """
+    def __init__(self, query):
+        self.query = query
+        self.search_id = get_search_id(query, get_counter(INDEX_GENERATION))
+        self.pages = {}
+
+    def get_page(self, number):
+        """
+        Get a page of results, numbered from 1, following the chain of page tokens from the last page that we
+        already have. Returns a dict with the page's groups, as (video_id, clips) tuples, the token for the next page,
+        and the total number of results.
+        """
+        for n in range(self.nearest_page(number) + 1, number + 1):
+            if n == 1:
+                metrics.increment('search_cache_misses')
+                logger.info('Searching', extra={'query': self.query})
+                results = TWELVE_LABS_CLIENT.search.query(
+                    TWELVE_LABS_INDEX_ID,
+                    SEARCH_OPTIONS['options'],
+                    query_text=self.query,
+                    group_by=SEARCH_OPTIONS['group_by'],
+                    threshold=SEARCH_OPTIONS['threshold'],
+                    page_limit=SEARCH_PAGE_LIMIT
+                )
+            else:
+                next_page_token = self.pages[n - 1]['next_page_token']
+                if not next_page_token:
+                    # There is no next page in search result
+                    return self.empty_page()
+                metrics.increment('search_cache_misses')
+                logger.debug('Getting page', extra={'query': self.query, 'page': n})
+                results = TWELVE_LABS_CLIENT.search.by_page_token(next_page_token)
+            self.add_page(n, results)
+
+        return self.pages[number]
+
+    async def aget_page(self, number):
+        """
+        Async version of get_page(), for async views, so that the worker can handle other requests while it waits for
+        Twelve Labs or the cache.
+        """
+        client = get_async_search_client()
+        for n in range(await self.anearest_page(number) + 1, number + 1):
+            if n == 1:
+                metrics.increment('search_cache_misses')
+                logger.info('Searching', extra={'query': self.query})
+                results = await client.query(
+                    TWELVE_LABS_INDEX_ID,
+                    SEARCH_OPTIONS['options'],
+                    query_text=self.query,
+                    group_by=SEARCH_OPTIONS['group_by'],
+                    threshold=SEARCH_OPTIONS['threshold'],
+                    page_limit=SEARCH_PAGE_LIMIT
+                )
+            else:
+                next_page_token = self.pages[n - 1]['next_page_token']
+                if not next_page_token:
+                    # There is no next page in search result
+                    return self.empty_page()
+                metrics.increment('search_cache_misses')
+                logger.debug('Getting page', extra={'query': self.query, 'page': n})
+                results = await client.by_page_token(next_page_token)
+            await self.aadd_page(n, results)
+
+        return self.pages[number]
+
+    def nearest_page(self, number):
+        """
+        Find the highest numbered page, up to number, that we already have, either in this object or in the cache.
+        Returns 0 if there are none.
+        """
+        cache = caches[SEARCH_CACHE]
+        first = number
+        while first > 0 and first not in self.pages:
+            page = cache.get(page_cache_key(self.search_id, first))
+            if page is not None:
+                metrics.increment('search_cache_hits')
+                self.pages[first] = page
+                break
+            first -= 1
+        return first
+
+    async def anearest_page(self, number):
+        """
+        Async version of nearest_page(). Cache backends that do I/O, such as DatabaseCache, can't be called
+        synchronously from an async view.
+        """
+        cache = caches[SEARCH_CACHE]
+        first = number
+        while first > 0 and first not in self.pages:
+            page = await cache.aget(page_cache_key(self.search_id, first))
+            if page is not None:
+                metrics.increment('search_cache_hits')
+                self.pages[first] = page
+                break
+            first -= 1
+        return first
+
+    def empty_page(self):
+        return {'groups': [], 'next_page_token': None, 'total_results': self.count()}
+
+    def keep_page(self, number, results):
+        """
+        Keep a page of results from Twelve Labs, returning it.
+        """
+        page = {
+            'groups': [(group.id, [clip.model_dump(include=CLIP_FIELDS) for clip in group.clips])
+                       for group in results.data],
+            'next_page_token': results.page_info.next_page_token,
+            'total_results': results.page_info.total_results,
+        }
+        self.pages[number] = page
+        return page
+
+    def add_page(self, number, results):
+        """
+        Keep a page of results from Twelve Labs, and cache it for as long as its next page token is good.
+        """
+        page = self.keep_page(number, results)
+        timeout = page_timeout(results)
+        if timeout:
+            caches[SEARCH_CACHE].set(page_cache_key(self.search_id, number), page, timeout=timeout)
+
+    async def aadd_page(self, number, results):
+        """
+        Async version of add_page().
+        """
+        page = self.keep_page(number, results)
+        timeout = page_timeout(results)
+        if timeout:
+            await caches[SEARCH_CACHE].aset(page_cache_key(self.search_id, number), page, timeout=timeout)
+
+    def count(self):
+        return self.get_page(1)['total_results']
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        """
+        The paginator slices the results to get each page. Retrieve the pages of results that cover the slice, then do
+        a single database query to get the videos.
+        """
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        start, stop, _ = index.indices(self.count())
+        groups = []
+        for number in range(start // SEARCH_PAGE_LIMIT + 1, (stop - 1) // SEARCH_PAGE_LIMIT + 2):
+            # Remember which page each group came from, for the link to its result page
+            groups += [(video_id, clips, number) for video_id, clips in self.get_page(number)['groups']]
+        offset = (start // SEARCH_PAGE_LIMIT) * SEARCH_PAGE_LIMIT
+        groups = groups[start - offset:stop - offset]
+
+        videos = {video.video_id: video
+                  for video in Video.objects.filter(video_id__in=[g[0] for g in groups]).exclude(video_id='')}
+
+        search_results = []
+        for video_id, clips, number in groups:
+            video = videos.get(video_id)
+            if video is None:
+                # There is a video in TwelveLabs, but no corresponding row in the database.
+                # Just report it and carry on.
+                logger.warning('Video is in Twelve Labs, but not in the database', extra={'video_id': video_id})
+                continue
+            result = SearchResult(video=video, clip_count=len(clips))
+            result.page = number
+            search_results.append(result)
+        return search_results
@@ -1,6 +1,9 @@
+from pathlib import PurePosixPath
+
 from rest_framework import serializers
 
-from .models import Notification, Video
+from cattube.settings import VIDEOS_PATH
+from .models import Notification, Video, DeletionJob
 
 
 class VideoSerializer(serializers.ModelSerializer):
@@ -13,3 +16,34 @@ class NotificationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Notification
         fields = ['transloadit', 'signature']
+
+
+class DeletionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DeletionJob
+        fields = ['id', 'created_at', 'finished_at', 'failed_at', 'total', 'deleted', 'failed']
+
+
+class UploadSerializer(serializers.Serializer):
+    """
+    Identifies the file being uploaded by a direct multipart upload. Only files directly under VIDEOS_PATH can be
+    uploaded.
+    """
+    key = serializers.CharField(max_length=1024)
+
+    def validate_key(self, value):
+        path = PurePosixPath(value)
+        if path.parent != PurePosixPath(VIDEOS_PATH) or path.name in ['', '.', '..']:
+            raise serializers.ValidationError(f'Uploads must be in {VIDEOS_PATH}')
+        return value
+
+
+class UploadPartSerializer(serializers.Serializer):
+    PartNumber = serializers.IntegerField(min_value=1, max_value=10000)
+    ETag = serializers.CharField()
+
+
+class CompleteUploadSerializer(UploadSerializer):
+    parts = UploadPartSerializer(many=True, allow_empty=False)
+    title = serializers.CharField(max_length=256)
+    index = serializers.BooleanField(default=False)
@@ -0,0 +1,95 @@
+import logging
+from datetime import timedelta
+from pathlib import Path
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from cattube.core.models import Video, SyncState
+from cattube.settings import VIDEOS_PATH, BUCKET_SYNC_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Name of the SyncState row used by the video list page
+VIDEOS_SYNC_STATE = 'videos'
+
+
+def start_sync_if_due(name=VIDEOS_SYNC_STATE):
+    """
+    If it has been more than BUCKET_SYNC_INTERVAL seconds since the last scan of the bucket started or finished, record
+    that a scan is starting now and return True, so that the caller runs one. Otherwise, return False. The check and
+    the update are a single query, so however many page views arrive at once, only one of them starts a scan.
+    """
+    now = timezone.now()
+    due = Q(synced_at__isnull=True) | Q(synced_at__lt=now - timedelta(seconds=BUCKET_SYNC_INTERVAL))
+    if SyncState.objects.filter(due, name=name).update(synced_at=now) > 0:
+        return True
+    if SyncState.objects.filter(name=name).exists():
+        return False
+    try:
+        # First scan
+        with transaction.atomic():
+            SyncState.objects.create(name=name, synced_at=now)
+        return True
+    except IntegrityError:
+        return False
+
+
+def sync_new_files(user, name=VIDEOS_SYNC_STATE):
+    """
+    Scan the videos path in the default storage a page at a time, adding any files that are not already in the
+    database. Progress is saved after each page, so an interrupted scan resumes from the last file it processed.
+    Returns the number of videos added.
+    """
+    state, _ = SyncState.objects.get_or_create(name=name)
+    logger.info('Syncing', extra={'path': VIDEOS_PATH, 'state': state})
+
+    added = 0
+    for files in default_storage.list_files(VIDEOS_PATH, start_after=state.last_key):
+        added += len(add_files(files, user))
+        save_progress(state, files)
+
+    finish_sync(state)
+
+    logger.info('Synced', extra={'path': VIDEOS_PATH, 'added': added})
+    return added
+
+
+def add_files(files, user, batch_size=None):
+    """
+    Add videos for a page of (name, last_modified) tuples from list_files(), skipping files that are already in the
+    database. Returns the new videos.
+    """
+    # One query per page to find out which of these files we already know about
+    modified_times = dict(files)
+    existing = set(Video.objects.filter(video__in=modified_times.keys()).values_list('video', flat=True))
+    new_videos = [Video(video=path,
+                        title=Path(path).stem,
+                        user=user,
+                        uploaded_at=modified_time)
+                  for path, modified_time in modified_times.items() if path not in existing]
+    if len(new_videos) > 0:
+        # Another scan may have added some of the same files since we looked
+        Video.objects.bulk_create(new_videos, batch_size=batch_size, ignore_conflicts=True)
+    return new_videos
+
+
+def save_progress(state, files):
+    """
+    Record that a scan has processed a page of files from list_files().
+    """
+    state.last_key = files[-1][0]
+    state.save(update_fields=['last_key'])
+
+
+def finish_sync(state):
+    """
+    Record that a scan has reached the end of the bucket.
+    """
+    # Listing keys is in name order, not time order, and a new file may have any name, so the next scan starts from
+    # the beginning again
+    state.last_key = ''
+    state.synced_at = timezone.now()
+    state.save(update_fields=['last_key', 'synced_at'])
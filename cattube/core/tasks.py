@@ -1,112 +1,341 @@
-import json
-from io import BytesIO
+import logging
+from datetime import timedelta
+from functools import cache
 from pathlib import Path
-from time import sleep
+from time import sleep, monotonic, time
 from urllib.parse import urlparse
-from urllib.request import urlopen
 
+import requests
+from django.contrib.auth.models import User
 from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+from huey import crontab
 from huey.contrib import djhuey as huey
+from huey.exceptions import TaskLockedException
+from requests.adapters import HTTPAdapter
 from transloadit import client as transload_it
-from twelvelabs import BadRequestError
+from urllib3.util import Retry
 
-from cattube.core.models import Video
+from cattube.core import metrics, queues
+from cattube.core.concurrency import TokenBucket, call_rate_limited, map_concurrently
+from cattube.core.deletion import run_deletion_job, retry_due, give_up
+from cattube.core.models import Video, StatusChange, DeletionJob, record_status_changes, bump_counter
+from cattube.core.search import INDEX_GENERATION
+from cattube.core.sync import start_sync_if_due, sync_new_files
 from cattube.core.utils import url_path_join
 from cattube.settings import TRANSLOADIT_KEY, TRANSLOADIT_SECRET, TWELVE_LABS_CLIENT, TWELVE_LABS_POLL_INTERVAL, \
-    TWELVE_LABS_INDEX_ID, THUMBNAILS_PATH
+    TWELVE_LABS_INDEX_ID, THUMBNAILS_PATH, BUCKET_SYNC_IN_BACKGROUND, TWELVE_LABS_MAX_POLL_INTERVAL, \
+    TWELVE_LABS_INDEXING_POLL_RATIO, TWELVE_LABS_POLL_PASS_DURATION, TWELVE_LABS_CREATE_CONCURRENCY, \
+    TWELVE_LABS_RATE_LIMIT, TWELVE_LABS_MAX_RETRIES, TWELVE_LABS_CREATE_BATCH_SIZE, STATUS_CHANGE_RETENTION, \
+    THUMBNAIL_CONCURRENCY, THUMBNAIL_MAX_RETRIES, THUMBNAIL_TIMEOUT, TWELVE_LABS_WEBHOOK_SECRET, \
+    TWELVE_LABS_SWEEP_INTERVAL, TRANSLOADIT_POLL_INTERVAL, TRANSLOADIT_MAX_POLL_INTERVAL, TRANSLOADIT_RATE_LIMIT_DELAY, \
+    TRANSLOADIT_POLL_TIMEOUT, DELETION_MAX_ATTEMPTS
 
+logger = logging.getLogger(__name__)
 
-@huey.db_task()
+
+def create_task(video, rate_limiter):
+    """
+    Create a Twelve Labs task to index the video, subject to the rate limit.
+    """
+    return call_rate_limited(rate_limiter, TWELVE_LABS_MAX_RETRIES,
+                             TWELVE_LABS_CLIENT.task.create,
+                             TWELVE_LABS_INDEX_ID,
+                             url=default_storage.url(video.video.name),
+                             enable_video_stream=False)
+
+
+def prepare_indexing(videos):
+    """
+    Mark the videos as being sent for indexing, so that the UI can show it, and return the argument for
+    do_video_indexing().
+    """
+    videos = list(videos)
+    video_dicts = []
+    for video in videos:
+        video.status = 'Sending'
+        video_dicts.append({
+            'id': video.id,
+            'video': video.video.name,
+            'status': 'Sending'
+        })
+    Video.objects.bulk_update(videos, ['status'])
+    record_status_changes(videos)
+    return video_dicts
+
+
+@queues.db_task()
 def do_video_indexing(video_tasks):
-    print(f'Creating tasks: {video_tasks}')
+    """
+    Create a Twelve Labs task for each video we want to index, then hand the tasks over to the poller, so this worker
+    is free as soon as the tasks are created. Up to TWELVE_LABS_CREATE_CONCURRENCY tasks are created at a time, at no
+    more than TWELVE_LABS_RATE_LIMIT per second, and the results are written to the database in batches.
+    """
+    logger.info('Creating tasks', extra={'count': len(video_tasks)})
+
+    # Do a single database query for all the videos we're interested in
+    videos = Video.objects.in_bulk([video_task['id'] for video_task in video_tasks])
+
+    rate_limiter = TokenBucket(TWELVE_LABS_RATE_LIMIT)
+    fields = ['status', 'task_id', 'poll_interval', 'next_poll_at']
+    videos_to_save = []
+    error_count = 0
+    polling = False
+    for video, task, ex in map_concurrently(lambda v: create_task(v, rate_limiter),
+                                            videos.values(),
+                                            TWELVE_LABS_CREATE_CONCURRENCY):
+        if ex:
+            logger.warning('Error creating task', extra={'file': video.video.name, 'error': str(ex)})
+            video.status = 'Error'
+            error_count += 1
+        else:
+            logger.debug('Created task', extra={'file': video.video.name, 'task_id': task.id, 'status': task.status})
+            # We store the status in the DB in title case, so it's ready to render on the page
+            video.status = task.status.title()
+            video.task_id = task.id
+            video.poll_interval = TWELVE_LABS_POLL_INTERVAL
+            video.next_poll_at = timezone.now()
+        videos_to_save.append(video)
+
+        if len(videos_to_save) >= TWELVE_LABS_CREATE_BATCH_SIZE:
+            Video.objects.bulk_update(videos_to_save, fields)
+            record_status_changes(videos_to_save)
+            videos_to_save = []
+            # Start polling the first batch now, rather than waiting for the next periodic run
+            if not polling:
+                poll_indexing_tasks()
+                polling = True
+
+    if len(videos_to_save) > 0:
+        Video.objects.bulk_update(videos_to_save, fields)
+        record_status_changes(videos_to_save)
+    logger.info('Created tasks', extra={'tasks': len(videos) - error_count, 'errors': error_count})
+
+    if not polling:
+        poll_indexing_tasks()
+
+
+def next_poll_interval(task, previous_interval, status_changed):
+    """
+    How long to wait before retrieving the task again. Validation is usually quick, and indexing takes time
+    proportional to the video's duration, so we poll accordingly; otherwise, for example while the task is pending,
+    we back off exponentially. If we receive webhook notifications, we only need to sweep occasionally.
+    """
+    if TWELVE_LABS_WEBHOOK_SECRET:
+        # Twelve Labs will tell us when the task is done; just check now and then in case we miss the notification
+        return TWELVE_LABS_SWEEP_INTERVAL
+
+    duration = task.system_metadata.get('duration')
+    if task.status == 'indexing' and duration:
+        interval = duration * TWELVE_LABS_INDEXING_POLL_RATIO
+    elif task.status == 'validating' or status_changed:
+        interval = TWELVE_LABS_POLL_INTERVAL
+    else:
+        interval = previous_interval * 2
+    return min(max(interval, TWELVE_LABS_POLL_INTERVAL), TWELVE_LABS_MAX_POLL_INTERVAL)
 
-    # Create a task for each video we want to index
-    error_tasks = []
-    for video_task in video_tasks:
+
+def retry_poll(video, now):
+    """
+    Back off before retrieving the video's task again, after an error.
+    """
+    video.poll_interval = min(max(video.poll_interval * 2, TWELVE_LABS_POLL_INTERVAL), TWELVE_LABS_MAX_POLL_INTERVAL)
+    video.next_poll_at = now + timedelta(seconds=video.poll_interval)
+
+
+def poll_task(video, now, thumbnails):
+    """
+    Retrieve the status of a video's indexing task, updating the video and scheduling its next poll, if any. When the
+    task is done, the video's id and thumbnail URL are appended to thumbnails. Returns True if the status changed.
+    """
+    try:
+        task = TWELVE_LABS_CLIENT.task.retrieve(video.task_id)
+    except Exception as ex:
+        logger.warning('Error retrieving task', extra={'task_id': video.task_id, 'file': video.video.name,
+                                                       'error': str(ex)})
+        retry_poll(video, now)
+        return False
+
+    # We store the status in the DB in title case, so it's ready to render on the page
+    new_status = task.status.title()
+    status_changed = video.status != new_status
+    if status_changed:
+        logger.debug('Updating status', extra={'file': video.video.name, 'old_status': video.status,
+                                               'new_status': new_status})
+        video.status = new_status
+
+    if task.done:
+        # A task that failed has no video
+        video.video_id = task.video_id or ''
+        video.next_poll_at = None
+        if task.hls and task.hls.thumbnail_urls and len(task.hls.thumbnail_urls) > 0:
+            thumbnails.append((video.id, task.hls.thumbnail_urls[0]))
+        else:
+            logger.info('No thumbnail', extra={'video_id': video.video_id})
+    else:
+        video.poll_interval = next_poll_interval(task, video.poll_interval, status_changed)
+        video.next_poll_at = now + timedelta(seconds=video.poll_interval)
+
+    return status_changed
+
+
+def poll_tasks(videos, now):
+    """
+    Retrieve the status of the videos' indexing tasks, writing the changes to the database in bulk.
+    """
+    if len(videos) == 0:
+        return
+
+    thumbnails = []
+    changed = []
+    for video in videos:
+        # One bad task mustn't stop the others from being updated
         try:
-            task = TWELVE_LABS_CLIENT.task.create(
-                TWELVE_LABS_INDEX_ID,
-                url=default_storage.url(video_task['video']),
-                enable_video_stream=False
-            )
-            print(f'Created task: {task}')
-            video_task['task_id'] = task.id
-        except BadRequestError as ex:
-            print(f'Error indexing {video_task['video']}: {ex.message}')
-            error_tasks.append(video_task)
-
-    print(f'{len(error_tasks)} errors creating tasks')
-    if len(error_tasks) > 0:
-        video_ids = [error_task['id'] for error_task in error_tasks]
-        videos = Video.objects.filter(id__in=video_ids)
+            if poll_task(video, now, thumbnails):
+                changed.append(video)
+        except Exception as ex:
+            logger.warning('Error polling task', extra={'task_id': video.task_id, 'file': video.video.name,
+                                                        'error': str(ex)})
+            retry_poll(video, now)
+
+    fields = ['status', 'video_id', 'poll_interval', 'next_poll_at']
+    try:
+        with transaction.atomic():
+            Video.objects.bulk_update(videos, fields)
+    except IntegrityError:
+        # Save the videos one at a time, so the rest are saved, and mark any video that can't be saved, for example
+        # because another video already has its video id, as an error, so it isn't polled again
         for video in videos:
-            video.status = 'Error'
-        Video.objects.bulk_update(videos, ['status'])
-        video_tasks = [video_task for video_task in video_tasks if video_task not in error_tasks]
+            try:
+                with transaction.atomic():
+                    video.save(update_fields=fields)
+            except IntegrityError as ex:
+                logger.warning('Error saving task status', extra={'task_id': video.task_id, 'video_id': video.video_id,
+                                                                  'error': str(ex)})
+                video.status = 'Error'
+                video.video_id = ''
+                video.next_poll_at = None
+                video.save(update_fields=fields)
+                if video not in changed:
+                    changed.append(video)
+                thumbnails = [(video_id, url) for video_id, url in thumbnails if video_id != video.id]
+    record_status_changes(changed)
+    # Copy thumbnails in a separate task, so slow downloads don't hold up polling
+    if len(thumbnails) > 0:
+        ingest_thumbnails(thumbnails)
+    # Newly indexed videos may now appear in search results
+    if any(video.next_poll_at is None for video in videos):
+        bump_counter(INDEX_GENERATION)
 
-    print(f'Created {len(video_tasks)} tasks')
 
-    print(f'Polling Twelve Labs for {video_tasks}')
+@queues.db_task(queue='polling')
+def handle_indexing_notification(task_id):
+    """
+    Twelve Labs has notified us that an indexing task is done. Retrieve the task, so we have the video id and
+    thumbnail, and update the video, without waiting for the next sweep.
+    """
+    videos = list(Video.objects.filter(task_id=task_id, next_poll_at__isnull=False))
+    if len(videos) == 0:
+        logger.info('No video is waiting for task', extra={'task_id': task_id})
+        return
+    poll_tasks(videos, timezone.now())
 
-    # Do a single database query for all the videos we're interested in
-    video_ids = [video_task['id'] for video_task in video_tasks]
-    videos = Video.objects.filter(id__in=video_ids)
-
-    while True:
-        done = True
-        videos_to_save = []
-
-        # Retrieve status for each task we created
-        for video_task in video_tasks:
-            # What's our current state for this video?
-            video = videos.get(video__exact=video_task['video'])
-
-            # Do we still need to retrieve status for this task?
-            if not video.done:
-                task = TWELVE_LABS_CLIENT.task.retrieve(video_task['task_id'])
-                if not task.done:
-                    # We'll need to go round the loop again
-                    done = False
-
-                # Do we need to write a new status to the DB?
-                if video.status.lower() != task.status:
-                    # We store the status in the DB in title case, so it's ready to render on the page
-                    new_status = task.status.title()
-                    print(f'Updating status for {video_task["video"]} from {video.status} to {new_status}')
-                    video.status = new_status
-                    if task.done:
-                        video.video_id = task.video_id
-                        get_thumbnail(video)
-                    videos_to_save.append(video)
-
-        if len(videos_to_save) > 0:
-            Video.objects.bulk_update(videos_to_save, ['status', 'video_id', THUMBNAILS_PATH])
-
-        if done:
-            break
-
-        sleep(TWELVE_LABS_POLL_INTERVAL)
-
-    print(f'Done polling {video_tasks}')
-
-
-def get_thumbnail(video: Video):
-    print(f'Getting thumbnail for {video.video_id}')
-    # Need to get the task to get the hls with the thumbnail ID
-    task = TWELVE_LABS_CLIENT.task.retrieve(video.video_id)
-    print(f'Got response: {task}')
-
-    if task.hls and task.hls.thumbnail_urls and len(task.hls.thumbnail_urls) > 0:
-        thumbnail_url = task.hls.thumbnail_urls[0]
-
-        url_parts = urlparse(thumbnail_url)
-        thumbnail_path = url_path_join(THUMBNAILS_PATH, f'{video.video_id}{Path(url_parts.path).suffix}')
-
-        print(f'Saving {thumbnail_url} to {thumbnail_path}')
-        default_storage.save(thumbnail_path, urlopen(thumbnail_url))
-        video.thumbnail = thumbnail_path
+
+@queues.db_periodic_task(crontab(), queue='polling')
+def poll_indexing_tasks():
+    """
+    A single poller for every outstanding indexing task, however many batches they were submitted in. Each task is
+    retrieved when it is due, and the resulting changes are written to the database in bulk. A pass runs for up to
+    TWELVE_LABS_POLL_PASS_DURATION seconds; a new pass starts every minute, and do_video_indexing starts one as soon
+    as it has created its tasks. The lock ensures that only one pass runs at a time.
+    """
+    try:
+        with huey.lock_task('poll-indexing-tasks'):
+            deadline = monotonic() + TWELVE_LABS_POLL_PASS_DURATION
+            while True:
+                now = timezone.now()
+                poll_tasks(list(Video.objects.filter(next_poll_at__lte=now)), now)
+
+                # Sleep until the next task is due, unless that's after the end of this pass
+                next_poll_at = Video.objects.aggregate(Min('next_poll_at'))['next_poll_at__min']
+                if next_poll_at is None:
+                    break
+                wait = (next_poll_at - timezone.now()).total_seconds()
+                if monotonic() + wait > deadline:
+                    break
+                if wait > 0:
+                    sleep(wait)
+    except TaskLockedException:
+        logger.debug('Already polling indexing tasks')
+
+
+@cache
+def http_session():
+    """
+    HTTP session shared by thumbnail downloads, so that they reuse connections, retrying on transient errors.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=THUMBNAIL_CONCURRENCY,
+                          max_retries=Retry(total=THUMBNAIL_MAX_RETRIES,
+                                            backoff_factor=0.5,
+                                            status_forcelist=[429, 500, 502, 503, 504]))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def ingest_thumbnail(video, thumbnail_url):
+    """
+    Copy the thumbnail from Twelve Labs to B2, streaming it from the download to the upload. The path is derived from
+    the video_id, so, if the thumbnail has already been copied, we don't need to do it again.
+    """
+    url_parts = urlparse(thumbnail_url)
+    thumbnail_path = url_path_join(THUMBNAILS_PATH, f'{video.video_id}{Path(url_parts.path).suffix}')
+
+    if video.thumbnail.name == thumbnail_path or default_storage.exists(thumbnail_path):
+        logger.debug('Already have thumbnail', extra={'file': thumbnail_path})
     else:
-        print(f'No thumbnail for {video.video_id}')
+        logger.debug('Saving thumbnail', extra={'url': thumbnail_url, 'file': thumbnail_path})
+        with metrics.timer('twelve_labs', 'thumbnail.get'):
+            response = http_session().get(thumbnail_url, stream=True, timeout=THUMBNAIL_TIMEOUT)
+        with response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            default_storage.save(thumbnail_path, response.raw)
+
+    return thumbnail_path
+
+
+@queues.db_task(queue='thumbnails', retries=THUMBNAIL_MAX_RETRIES, retry_delay=10)
+def ingest_thumbnails(thumbnails):
+    """
+    Copy thumbnails for a list of (video id, thumbnail URL) tuples, up to THUMBNAIL_CONCURRENCY at a time. Huey
+    retries the task if any of them fail, skipping the ones that were already copied.
+    """
+    thumbnail_urls = dict(thumbnails)
+    videos = Video.objects.in_bulk(thumbnail_urls.keys())
+
+    videos_to_save = []
+    failed = []
+    for video, thumbnail_path, ex in map_concurrently(lambda v: ingest_thumbnail(v, thumbnail_urls[v.id]),
+                                                      videos.values(),
+                                                      THUMBNAIL_CONCURRENCY):
+        if ex:
+            logger.warning('Error saving thumbnail', extra={'video_id': video.video_id, 'error': str(ex)})
+            failed.append((video.id, thumbnail_urls[video.id]))
+        elif video.thumbnail.name != thumbnail_path:
+            video.thumbnail = thumbnail_path
+            videos_to_save.append(video)
+
+    if len(videos_to_save) > 0:
+        Video.objects.bulk_update(videos_to_save, ['thumbnail'])
+        # Let the front end know that the thumbnails are available
+        record_status_changes(videos_to_save)
+
+    if len(failed) > 0:
+        raise Exception(f'Failed to save {len(failed)} thumbnails')
 
 
 def assembly_finished(assembly):
@@ -123,21 +352,119 @@ def assembly_finished(assembly):
     return is_aborted or is_canceled or is_completed or (is_failed and not is_fetch_rate_limit)
 
 
-@huey.db_task()
-def poll_video_loading(assembly_id):
-    print(f'Polling TransloadIt for {assembly_id}')
+@cache
+def transloadit_client():
+    """
+    Transloadit client shared by all the polling tasks in this process, recording the duration of each call.
+    """
+    return metrics.instrument(transload_it.Transloadit(TRANSLOADIT_KEY, TRANSLOADIT_SECRET), 'transloadit')
+
+
+def next_loading_poll_interval(assembly, previous_interval):
+    """
+    How long to wait before retrieving the assembly again. We back off exponentially, and wait longer if Transloadit
+    says we're retrieving it too often.
+    """
+    if assembly and assembly.get('error') == 'ASSEMBLY_STATUS_FETCHING_RATE_LIMIT_REACHED':
+        return max(previous_interval * 2, TRANSLOADIT_RATE_LIMIT_DELAY)
+    return min(previous_interval * 2, TRANSLOADIT_MAX_POLL_INTERVAL)
+
+
+@queues.db_task(queue='polling')
+def poll_video_loading(assembly_id, interval=TRANSLOADIT_POLL_INTERVAL, started_at=None):
+    """
+    Retrieve the status of an upload from Transloadit, updating the video when it's done. Rather than tying up a worker
+    while the upload is in progress, the task schedules itself to run again, backing off each time.
+    """
+    started_at = started_at or time()
+
+    # Nothing to do if the notification from Transloadit has already updated the video, or it has been deleted
+    video = Video.objects.filter(assembly_id=assembly_id).exclude(assembly_id='').first()
+    if video is None or video.video:
+        logger.debug('Done polling', extra={'assembly_id': assembly_id})
+        return
+
+    logger.debug('Polling Transloadit', extra={'assembly_id': assembly_id})
+    assembly = None
+    try:
+        assembly = transloadit_client().get_assembly(assembly_id).data
+        logger.debug('Retrieved assembly', extra={'assembly_id': assembly_id, 'ok': assembly.get('ok'),
+                                                  'error': assembly.get('error', '')})
+    except Exception as ex:
+        logger.warning('Error retrieving assembly', extra={'assembly_id': assembly_id, 'error': str(ex)})
+
+    if assembly and assembly_finished(assembly):
+        video.update_from_assembly(assembly)
+        logger.info('Done polling', extra={'assembly_id': assembly_id})
+        return
+
+    interval = next_loading_poll_interval(assembly, interval)
+    if time() + interval - started_at > TRANSLOADIT_POLL_TIMEOUT:
+        logger.warning('Giving up polling', extra={'assembly_id': assembly_id})
+        return
+    poll_video_loading.schedule(args=(assembly_id, interval, started_at), delay=interval)
+
+
+@queues.db_task(queue='deletion')
+def do_deletion_job(job_id):
+    """
+    Run a deletion job in the background, so large deletions don't time out the request. The lock ensures that each
+    job only runs once at a time.
+    """
+    try:
+        with huey.lock_task(f'deletion-job-{job_id}'):
+            run_deletion_job(DeletionJob.objects.get(id=job_id))
+    except TaskLockedException:
+        logger.info('Already running deletion job', extra={'job_id': job_id})
+
+
+@queues.db_periodic_task(crontab(minute='*/5'), queue='deletion')
+def resume_deletion_jobs():
+    """
+    Restart deletion jobs that were interrupted, for example, by the Huey consumer being restarted, and retry jobs that
+    finished with videos that could not be deleted, backing off after each run. Jobs that have been run
+    DELETION_MAX_ATTEMPTS times are given up on.
+    """
+    now = timezone.now()
+    jobs = DeletionJob.objects.filter(Q(finished_at__isnull=True) | Q(videos__isnull=False),
+                                      failed_at__isnull=True, created_at__lt=now - timedelta(minutes=5))
+    for job in jobs.distinct():
+        if not retry_due(job, now):
+            continue
+        if job.attempts >= DELETION_MAX_ATTEMPTS:
+            give_up(job)
+        else:
+            do_deletion_job(job.id)
+
+
+@queues.db_periodic_task(crontab(minute='0'))
+def prune_status_changes():
+    """
+    Remove entries older than STATUS_CHANGE_RETENTION seconds from the status change journal.
+    """
+    cutoff = timezone.now() - timedelta(seconds=STATUS_CHANGE_RETENTION)
+    deleted, _ = StatusChange.objects.filter(created_at__lt=cutoff).delete()
+    logger.info('Pruned status changes', extra={'deleted': deleted})
 
-    client = transload_it.Transloadit(TRANSLOADIT_KEY, TRANSLOADIT_SECRET)
 
-    while True:
-        response = client.get_assembly(assembly_id)
-        assembly = response.data
-        print(f"Found assembly: {json.dumps(assembly, indent=2)}")
-        if assembly_finished(assembly):
-            video = Video.objects.get(assembly_id__exact=assembly_id)
-            video.update_from_assembly(assembly)
-            break
+@queues.db_task()
+@huey.lock_task('sync-bucket')
+def sync_bucket(user_id):
+    """
+    Add any new files in the bucket to the database. The lock ensures that only one scan runs at a time.
+    """
+    sync_new_files(User.objects.get(id=user_id))
 
-        sleep(1)
 
-    print(f'Done polling {assembly_id}')
+def add_new_files(user):
+    """
+    Helper function to add files in the default storage to the database if they do not already exist. By default,
+    the bucket is scanned by a Huey task, at most once every BUCKET_SYNC_INTERVAL seconds, so that page views never
+    wait on the storage listing. The scan is recorded as started before the task is enqueued, so page views that
+    arrive while it is queued or running don't enqueue more.
+    """
+    if user.is_authenticated and start_sync_if_due():
+        if BUCKET_SYNC_IN_BACKGROUND:
+            sync_bucket(user.id)
+        else:
+            sync_new_files(user)
@@ -1 +1,884 @@
-# Create your tests here.
+import hashlib
+import hmac
+import json
+import os
+import re
+import tempfile
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from botocore.stub import ANY, Stubber
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.paginator import InvalidPage
+from django.db import connection
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from huey import MemoryHuey, signals
+from huey.contrib import djhuey
+
+from cattube.core.api import get_status_changes_async
+from cattube.core.deletion import run_deletion_job
+from cattube.core import metrics
+from cattube.core.pagination import KeysetPaginator, make_cursor, parse_cursor
+from cattube.core.models import Video, StatusChange, DeletionJob, SyncState, bump_counter, record_status_changes
+from cattube.core.queues import DEFAULT_QUEUE, ENQUEUED_AT, get_queue, record_enqueue, record_latency, timed
+from cattube.core.serializers import UploadSerializer
+from cattube.core.search import LazySearchResults, INDEX_GENERATION
+from cattube.core.tasks import poll_tasks, resume_deletion_jobs, add_new_files, next_loading_poll_interval, \
+    poll_video_loading
+from cattube.core.utils import url_path_join
+from cattube.settings import VIDEOS_PATH, SIGNED_URL_WINDOW, STATUS_POLL_INTERVAL, BUCKET_SYNC_INTERVAL, \
+    TRANSLOADIT_MAX_POLL_INTERVAL, TRANSLOADIT_RATE_LIMIT_DELAY, QUEUE_LATENCY_WARNING, DELETION_RETRY_DELAY, \
+    DELETION_MAX_ATTEMPTS
+from cattube.storage import CachedS3Storage
+
+
+def fake_task(status, video_id=None, thumbnail_url=None):
+    """
+    Stand-in for a Twelve Labs indexing task, with just the fields the poller reads.
+    """
+    return SimpleNamespace(status=status, done=status in ('ready', 'failed'), video_id=video_id,
+                           hls=SimpleNamespace(thumbnail_urls=[thumbnail_url] if thumbnail_url else None),
+                           system_metadata={})
+
+
+def fake_client(tasks):
+    """
+    Twelve Labs client whose task.retrieve() returns the task with the given id from tasks, or raises it if it's an
+    exception.
+    """
+    def retrieve(task_id):
+        task = tasks[task_id]
+        if isinstance(task, Exception):
+            raise task
+        return task
+    return SimpleNamespace(task=SimpleNamespace(retrieve=retrieve))
+
+
+def create_videos(user, count):
+    now = timezone.now()
+    return [Video.objects.create(title=f'video {i}', user=user, video=f'videos/{i}.mp4', status='Indexing',
+                                 task_id=f'task{i}', poll_interval=1, next_poll_at=now)
+            for i in range(count)]
+
+
+@patch('cattube.core.tasks.ingest_thumbnails')
+class PollTasksTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+
+    def poll(self, tasks):
+        with patch('cattube.core.tasks.TWELVE_LABS_CLIENT', fake_client(tasks)):
+            poll_tasks(list(Video.objects.filter(next_poll_at__isnull=False)), timezone.now())
+
+    def test_failed_task(self, ingest_thumbnails):
+        failed, ready = create_videos(self.user, 2)
+        self.poll({'task0': fake_task('failed'), 'task1': fake_task('ready', 'v1', 'https://example.com/v1.jpg')})
+
+        failed.refresh_from_db()
+        ready.refresh_from_db()
+        self.assertEqual((failed.status, failed.video_id, failed.next_poll_at), ('Failed', '', None))
+        self.assertEqual((ready.status, ready.video_id, ready.next_poll_at), ('Ready', 'v1', None))
+        ingest_thumbnails.assert_called_once_with([(ready.id, 'https://example.com/v1.jpg')])
+
+    def test_error_polling_one_task(self, ingest_thumbnails):
+        broken, ready = create_videos(self.user, 2)
+        self.poll({'task0': fake_task(None), 'task1': fake_task('ready', 'v1')})
+
+        broken.refresh_from_db()
+        ready.refresh_from_db()
+        self.assertEqual(broken.status, 'Indexing')
+        self.assertGreater(broken.next_poll_at, timezone.now())
+        self.assertEqual((ready.status, ready.video_id), ('Ready', 'v1'))
+
+    def test_error_saving_one_video(self, ingest_thumbnails):
+        indexed, duplicate, ready = create_videos(self.user, 3)
+        Video.objects.filter(id=indexed.id).update(status='Ready', video_id='v0', next_poll_at=None)
+        # The second video's task claims the first video's video id
+        self.poll({'task1': fake_task('ready', 'v0', 'https://example.com/v0.jpg'),
+                   'task2': fake_task('ready', 'v2', 'https://example.com/v2.jpg')})
+
+        duplicate.refresh_from_db()
+        ready.refresh_from_db()
+        self.assertEqual((duplicate.status, duplicate.video_id, duplicate.next_poll_at), ('Error', '', None))
+        self.assertEqual((ready.status, ready.video_id), ('Ready', 'v2'))
+        ingest_thumbnails.assert_called_once_with([(ready.id, 'https://example.com/v2.jpg')])
+
+
+def fake_assembly(assembly_id, name):
+    return {'assembly_id': assembly_id, 'results': {':original': [{'name': name}]}}
+
+
+class UpdateFromAssemblyTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.upload = Video.objects.create(title='My video', user=self.user, assembly_id='a1')
+
+    def test_new_file(self):
+        video = self.upload.update_from_assembly(fake_assembly('a1', 'new.mp4'))
+
+        self.assertEqual(video.id, self.upload.id)
+        self.assertTrue(Video.objects.get(id=video.id).video.name.endswith('/new.mp4'))
+
+    def test_file_already_indexed(self):
+        other = User.objects.create(username='other')
+        indexed = Video.objects.create(title='old.mp4', user=other, video=url_path_join(VIDEOS_PATH, 'old.mp4'),
+                                       status='Ready', video_id='v1', thumbnail='thumbnails/v1.jpg')
+
+        video = self.upload.update_from_assembly(fake_assembly('a1', 'old.mp4'))
+
+        self.assertEqual(video.id, indexed.id)
+        self.assertEqual(list(Video.objects.values_list('id', flat=True)), [indexed.id])
+        indexed.refresh_from_db()
+        self.assertEqual((indexed.title, indexed.user, indexed.assembly_id), ('My video', self.user, 'a1'))
+        self.assertEqual((indexed.status, indexed.video_id, indexed.thumbnail.name),
+                         ('Ready', 'v1', 'thumbnails/v1.jpg'))
+        self.assertTrue(StatusChange.objects.filter(video=indexed).exists())
+
+
+class PollVideoLoadingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.video = Video.objects.create(title='upload', user=self.user, assembly_id='a1')
+
+    def test_backoff(self):
+        uploading = {'ok': 'ASSEMBLY_UPLOADING'}
+        self.assertEqual(next_loading_poll_interval(uploading, 1), 2)
+        self.assertEqual(next_loading_poll_interval(None, 4), 8)
+        self.assertEqual(next_loading_poll_interval(uploading, TRANSLOADIT_MAX_POLL_INTERVAL),
+                         TRANSLOADIT_MAX_POLL_INTERVAL)
+        rate_limited = {'error': 'ASSEMBLY_STATUS_FETCHING_RATE_LIMIT_REACHED'}
+        self.assertEqual(next_loading_poll_interval(rate_limited, 1), TRANSLOADIT_RATE_LIMIT_DELAY)
+        self.assertEqual(next_loading_poll_interval(rate_limited, TRANSLOADIT_RATE_LIMIT_DELAY),
+                         TRANSLOADIT_RATE_LIMIT_DELAY * 2)
+
+    def poll(self, assembly):
+        with patch('cattube.core.tasks.transloadit_client') as transloadit_client, \
+                patch('cattube.core.tasks.poll_video_loading') as task:
+            transloadit_client.return_value.get_assembly.return_value.data = assembly
+            poll_video_loading.call_local('a1', 2, started_at=None)
+        return transloadit_client, task
+
+    def test_reschedules_while_uploading(self):
+        _, task = self.poll({'ok': 'ASSEMBLY_UPLOADING'})
+        kwargs = task.schedule.call_args.kwargs
+        self.assertEqual(kwargs['args'][:2], ('a1', 4))
+        self.assertEqual(kwargs['delay'], 4)
+
+    def test_stops_once_video_has_its_file(self):
+        # The notification from Transloadit got there first
+        Video.objects.filter(id=self.video.id).update(video='videos/upload.mp4')
+        transloadit_client, task = self.poll({'ok': 'ASSEMBLY_UPLOADING'})
+        transloadit_client.assert_not_called()
+        task.schedule.assert_not_called()
+
+    def test_stops_once_video_is_deleted(self):
+        self.video.delete()
+        transloadit_client, task = self.poll({'ok': 'ASSEMBLY_UPLOADING'})
+        transloadit_client.assert_not_called()
+        task.schedule.assert_not_called()
+
+
+def fake_search_results(video_ids):
+    """
+    Stand-in for a page of Twelve Labs search results, grouped by video, with one clip per video.
+    """
+    clip = SimpleNamespace(model_dump=lambda include: {'start': 0, 'end': 1, 'confidence': 'high', 'metadata': []})
+    return SimpleNamespace(data=[SimpleNamespace(id=video_id, clips=[clip]) for video_id in video_ids],
+                           page_info=SimpleNamespace(next_page_token=None, total_results=len(video_ids),
+                                                     page_expires_at=None))
+
+
+# Each test starts with an empty search cache
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'search': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-search'},
+})
+@patch('cattube.core.tasks.ingest_thumbnails')
+class QueryCountTests(TestCase):
+    """
+    The number of queries for a batch of videos must not grow with the size of the batch.
+    """
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.client.force_login(self.user)
+
+    def assertConstantQueries(self, fn, small, large):
+        """
+        Call fn with a batch of small videos, then large videos, and check that the second call makes as many queries as
+        the first.
+        """
+        videos = create_videos(self.user, small)
+        with CaptureQueriesContext(connection) as queries:
+            fn(videos)
+        Video.objects.all().delete()
+        videos = create_videos(self.user, large)
+        with self.assertNumQueries(len(queries)):
+            fn(videos)
+
+    def test_get_status(self, ingest_thumbnails):
+        def get_status(videos):
+            response = self.client.post('/api/videos/status', [{'id': video.id} for video in videos],
+                                        content_type='application/json')
+            self.assertEqual(len(response.json()), len(videos))
+        self.assertConstantQueries(get_status, 2, 20)
+
+    def test_get_status_by_ids(self, ingest_thumbnails):
+        def get_status(videos):
+            response = self.client.post('/api/videos/status', {'ids': [video.id for video in videos]},
+                                        content_type='application/json')
+            self.assertEqual(len(response.json()['videos']), len(videos))
+        self.assertConstantQueries(get_status, 2, 20)
+
+    def test_search_results(self, ingest_thumbnails):
+        def search(videos):
+            for video in videos:
+                video.video_id = f'video{video.id}'
+            Video.objects.bulk_update(videos, ['video_id'])
+            client = SimpleNamespace(search=SimpleNamespace(
+                query=lambda *args, **kwargs: fake_search_results([video.video_id for video in videos])))
+            with patch('cattube.core.search.TWELVE_LABS_CLIENT', client):
+                results = LazySearchResults(f'cats {len(videos)}')
+                self.assertEqual(len(results[0:len(videos)]), len(videos))
+        self.assertConstantQueries(search, 2, 10)
+
+    def test_poll_tasks(self, ingest_thumbnails):
+        # The first pass to see a task finish would otherwise create the counter
+        bump_counter(INDEX_GENERATION)
+
+        def poll(videos):
+            # Half the tasks finish, and half are still indexing
+            tasks = {video.task_id: fake_task('ready', f'video{video.id}', 'https://example.com/thumbnail.jpg')
+                     if i % 2 else fake_task('indexing') for i, video in enumerate(videos)}
+            with patch('cattube.core.tasks.TWELVE_LABS_CLIENT', fake_client(tasks)):
+                poll_tasks(videos, timezone.now())
+        self.assertConstantQueries(poll, 2, 20)
+
+
+class GetStatusTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.client.force_login(self.user)
+        self.videos = create_videos(self.user, 3)
+
+    def get_status(self, data):
+        return self.client.post('/api/videos/status', data, content_type='application/json')
+
+    def test_changes_since(self):
+        ids = [video.id for video in self.videos]
+        data = self.get_status({'ids': ids}).json()
+        self.assertEqual(sorted(video['id'] for video in data['videos']), ids)
+
+        # Nothing has changed
+        self.assertEqual(self.get_status({'ids': ids, 'since': data['cursor']}).status_code, 304)
+
+        # Just the video that changed, and a cursor that moves past the change
+        self.videos[1].status = 'Ready'
+        self.videos[1].save()
+        record_status_changes([self.videos[1]])
+        changes = self.get_status({'ids': ids, 'since': data['cursor']}).json()
+        self.assertEqual([(video['id'], video['status']) for video in changes['videos']],
+                         [(self.videos[1].id, 'Ready')])
+        self.assertGreater(changes['cursor'], data['cursor'])
+        self.assertEqual(self.get_status({'ids': ids, 'since': changes['cursor']}).status_code, 304)
+
+        # Changes to other videos don't count
+        self.assertEqual(self.get_status({'ids': [self.videos[0].id], 'since': data['cursor']}).status_code, 304)
+
+    def test_list(self):
+        deleted_id = self.videos[2].id
+        self.videos[2].delete()
+        data = self.get_status([{'id': self.videos[0].id, 'title': 'video 0'}, {'id': deleted_id}]).json()
+
+        # The deleted video is left out, and the other keeps the fields that were sent
+        self.assertEqual(len(data), 1)
+        self.assertEqual((data[0]['id'], data[0]['title'], data[0]['status'], data[0]['thumbnail']),
+                         (self.videos[0].id, 'video 0', 'Indexing', None))
+        self.assertIn('videos/0.mp4', data[0]['original'])
+
+
+class StatusChangesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.client.force_login(self.user)
+        self.videos = create_videos(self.user, 2)
+
+    def get_changes(self, data):
+        return self.client.post('/api/videos/changes', data, content_type='application/json')
+
+    def test_changes(self):
+        # More ids than would fit in a request line
+        ids = [video.id for video in self.videos] + list(range(100000, 105000))
+        response = self.get_changes({'ids': ids})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['videos']), 2)
+        self.assertEqual(data['poll_interval'], STATUS_POLL_INTERVAL)
+
+        # Under WSGI, no changes means an empty response, straight away
+        data = self.get_changes({'ids': ids, 'since': data['cursor']}).json()
+        self.assertEqual(data['videos'], [])
+
+        self.videos[0].status = 'Ready'
+        self.videos[0].save()
+        record_status_changes([self.videos[0]])
+        data = self.get_changes({'ids': ids, 'since': data['cursor']}).json()
+        self.assertEqual([(video['id'], video['status']) for video in data['videos']], [(self.videos[0].id, 'Ready')])
+
+    def test_invalid(self):
+        for data in [{}, {'ids': 'x'}, {'ids': [1], 'since': 'x'}, [1, 2]]:
+            self.assertEqual(self.get_changes(data).status_code, 400)
+
+    async def test_async_changes(self):
+        request = AsyncRequestFactory().post('/api/videos/changes', {'ids': [video.id for video in self.videos]},
+                                             content_type='application/json')
+
+        async def auser():
+            return self.user
+        request.auser = auser
+
+        response = await get_status_changes_async(request)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(len(data['videos']), 2)
+        self.assertEqual(data['poll_interval'], 0)
+
+
+class FakeAsyncSearchClient:
+    def __init__(self, video_ids):
+        self.video_ids = video_ids
+
+    async def query(self, *args, **kwargs):
+        return fake_search_results(self.video_ids)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'search': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'test_search_cache'},
+})
+class AsyncSearchTests(TestCase):
+    def setUp(self):
+        call_command('createcachetable', 'test_search_cache', verbosity=0)
+
+    async def test_database_cache(self):
+        with patch('cattube.core.search.get_async_search_client', return_value=FakeAsyncSearchClient(['v1', 'v2'])):
+            results = await sync_to_async(LazySearchResults)('cats')
+            page = await results.aget_page(1)
+            # A second request finds the page in the cache
+            cached = await (await sync_to_async(LazySearchResults)('cats')).aget_page(1)
+
+        self.assertEqual([video_id for video_id, clips in page['groups']], ['v1', 'v2'])
+        self.assertEqual(cached, page)
+
+
+def create_signer():
+    """
+    A storage with its own URL cache, like the one in each web app process.
+    """
+    return CachedS3Storage(access_key='key', secret_key='secret', endpoint_url='https://s3.us-west-004.backblazeb2.com',
+                           region_name='us-west-004', bucket_name='bucket', location='videos')
+
+
+@patch('cattube.storage.STABLE_SIGNED_URLS', True)
+class StableSignedUrlTests(TestCase):
+    window_start = 1_700_000_000 // SIGNED_URL_WINDOW * SIGNED_URL_WINDOW
+
+    def url_at(self, signer, timestamp):
+        with patch('cattube.storage.time', return_value=timestamp):
+            return signer.url('cat.mp4')
+
+    def test_same_url_within_window(self):
+        first = self.url_at(create_signer(), self.window_start + 10)
+        second = self.url_at(create_signer(), self.window_start + SIGNED_URL_WINDOW - 1)
+
+        self.assertEqual(first, second)
+        self.assertIn('X-Amz-Date=20231114T', first)
+        self.assertIn('response-cache-control=', first)
+
+    def test_new_url_in_next_window(self):
+        signer = create_signer()
+        first = self.url_at(signer, self.window_start + 10)
+        second = self.url_at(signer, self.window_start + SIGNED_URL_WINDOW)
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(second, self.url_at(create_signer(), self.window_start + SIGNED_URL_WINDOW + 10))
+
+
+class DeleteManyTests(TestCase):
+    def test_missing_files_are_deleted(self):
+        storage = create_signer()
+        with Stubber(storage.connection.meta.client) as stub:
+            stub.add_response('delete_objects', {'Errors': [
+                {'Key': 'videos/gone.mp4', 'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'},
+                {'Key': 'videos/locked.mp4', 'Code': 'AccessDenied', 'Message': 'Access Denied'},
+            ]})
+            failed = storage.delete_many(['gone.mp4', 'locked.mp4', 'cat.mp4'])
+
+        self.assertEqual(failed, ['locked.mp4'])
+
+
+class DirectUploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.client.force_login(self.user)
+
+    def test_keys_outside_videos_path(self):
+        self.assertTrue(UploadSerializer(data={'key': url_path_join(VIDEOS_PATH, 'cat.mp4')}).is_valid())
+        for key in ['cat.mp4', f'{VIDEOS_PATH}/', f'{VIDEOS_PATH}/..', f'{VIDEOS_PATH}/../settings.py',
+                    f'{VIDEOS_PATH}/cats/cat.mp4', 'thumbnails/cat.jpg', f'/{VIDEOS_PATH}/cat.mp4']:
+            self.assertFalse(UploadSerializer(data={'key': key}).is_valid(), key)
+
+    def test_upload(self):
+        storage = create_signer()
+        with Stubber(storage.connection.meta.client) as stub, patch('cattube.core.api.default_storage', storage):
+            stub.add_response('create_multipart_upload', {'UploadId': 'upload1'},
+                              {'Bucket': 'bucket', 'Key': ANY, 'ContentType': 'video/mp4'})
+            response = self.client.post('/api/uploads', {'filename': '../My cat.mp4', 'type': 'video/mp4'})
+            self.assertEqual(response.status_code, 201)
+            key = response.json()['key']
+            self.assertEqual(response.json()['uploadId'], 'upload1')
+            self.assertRegex(key, rf'^{VIDEOS_PATH}/My_cat-[0-9a-f]{{8}}\.mp4$')
+
+            response = self.client.get('/api/uploads/upload1/parts/1', {'key': key})
+            self.assertIn('uploadId=upload1', response.json()['url'])
+            self.assertIn('partNumber=1', response.json()['url'])
+            response = self.client.get('/api/uploads/upload1/parts/1', {'key': 'thumbnails/cat.jpg'})
+            self.assertEqual(response.status_code, 400)
+
+            stub.add_response('complete_multipart_upload', {}, {
+                'Bucket': 'bucket', 'Key': f'videos/{key}', 'UploadId': 'upload1',
+                'MultipartUpload': {'Parts': [{'PartNumber': 1, 'ETag': '"e1"'}, {'PartNumber': 2, 'ETag': '"e2"'}]},
+            })
+            # The parts are put in order
+            parts = [{'PartNumber': 2, 'ETag': '"e2"'}, {'PartNumber': 1, 'ETag': '"e1"'}]
+            response = self.client.post('/api/uploads/upload1/complete',
+                                        {'key': key, 'title': 'My cat', 'parts': parts},
+                                        content_type='application/json')
+            stub.assert_no_pending_responses()
+
+        self.assertEqual(response.status_code, 201)
+        video = Video.objects.get(id=response.json()['id'])
+        self.assertEqual((video.video.name, video.title, video.user), (key, 'My cat', self.user))
+        self.assertTrue(StatusChange.objects.filter(video=video).exists())
+
+
+class FakeStorage:
+    """
+    Storage whose delete_many() fails for the names in undeletable.
+    """
+    def __init__(self, undeletable):
+        self.undeletable = undeletable
+        self.deleted = []
+
+    def delete_many(self, names):
+        names = list(names)
+        self.deleted += [name for name in names if name not in self.undeletable]
+        return [name for name in names if name in self.undeletable]
+
+
+class DeletionJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.videos = create_videos(self.user, 3)
+        for video in self.videos:
+            video.video_id = f'video{video.id}'
+            video.thumbnail = f'thumbnails/{video.id}.jpg'
+        Video.objects.bulk_update(self.videos, ['video_id', 'thumbnail'])
+        self.job = DeletionJob.objects.create()
+        self.job.total = Video.objects.update(deletion_job=self.job)
+        self.job.save()
+        self.index = []
+        self.twelve_labs_client = SimpleNamespace(index=SimpleNamespace(video=SimpleNamespace(
+            delete=lambda index_id, video_id: self.index.append(video_id))))
+
+    def run_job(self, storage):
+        with patch('cattube.core.deletion.default_storage', storage), \
+                patch('cattube.core.deletion.TWELVE_LABS_CLIENT', self.twelve_labs_client):
+            run_deletion_job(DeletionJob.objects.get(id=self.job.id))
+        return DeletionJob.objects.get(id=self.job.id)
+
+    def test_failure_is_retried(self):
+        failing = self.videos[1]
+        storage = FakeStorage({f'thumbnails/{failing.id}.jpg'})
+
+        job = self.run_job(storage)
+
+        # The video whose thumbnail couldn't be deleted stays in the job, and isn't deleted from the index
+        self.assertEqual((job.deleted, job.failed), (2, 1))
+        self.assertEqual(list(job.videos.values_list('id', flat=True)), [failing.id])
+        self.assertNotIn(failing.video_id, self.index)
+        self.assertIn(failing.video.name, storage.deleted)
+
+        # The job is retried, even though it has finished, once the retry delay has passed
+        self.backdate(DELETION_RETRY_DELAY - 60)
+        with patch('cattube.core.tasks.do_deletion_job') as do_deletion_job:
+            resume_deletion_jobs.call_local()
+        do_deletion_job.assert_not_called()
+        self.backdate(DELETION_RETRY_DELAY + 60)
+        with patch('cattube.core.tasks.do_deletion_job') as do_deletion_job:
+            resume_deletion_jobs.call_local()
+        do_deletion_job.assert_called_once_with(job.id)
+
+        job = self.run_job(FakeStorage(set()))
+
+        self.assertEqual((job.deleted, job.failed, job.attempts), (3, 0, 2))
+        self.assertFalse(Video.objects.exists())
+        self.assertIn(failing.video_id, self.index)
+        self.assertIsNone(job.failed_at)
+
+    def backdate(self, seconds):
+        DeletionJob.objects.filter(id=self.job.id).update(created_at=timezone.now() - timedelta(seconds=seconds),
+                                                         started_at=timezone.now() - timedelta(seconds=seconds))
+
+    def resumed(self):
+        with patch('cattube.core.tasks.do_deletion_job') as do_deletion_job:
+            resume_deletion_jobs.call_local()
+        return do_deletion_job.called
+
+    def test_gives_up(self):
+        storage = FakeStorage({f'thumbnails/{self.videos[1].id}.jpg'})
+        for attempt in range(1, DELETION_MAX_ATTEMPTS + 1):
+            job = self.run_job(storage)
+            self.assertEqual(job.attempts, attempt)
+            # Each retry waits twice as long as the last
+            delay = DELETION_RETRY_DELAY * 2 ** (attempt - 1)
+            self.backdate(delay - 60)
+            self.assertFalse(self.resumed())
+            self.backdate(delay + 60)
+            self.assertEqual(self.resumed(), attempt < DELETION_MAX_ATTEMPTS)
+
+        job = DeletionJob.objects.get(id=self.job.id)
+        self.assertIsNotNone(job.failed_at)
+        self.assertEqual(list(job.videos.values_list('id', flat=True)), [self.videos[1].id])
+
+    def test_interrupted_job_gives_up(self):
+        DeletionJob.objects.filter(id=self.job.id).update(attempts=DELETION_MAX_ATTEMPTS)
+        self.backdate(DELETION_RETRY_DELAY * 2 ** DELETION_MAX_ATTEMPTS)
+        self.assertFalse(self.resumed())
+        self.assertIsNotNone(DeletionJob.objects.get(id=self.job.id).failed_at)
+
+    def test_exception_on_last_attempt(self):
+        DeletionJob.objects.filter(id=self.job.id).update(attempts=DELETION_MAX_ATTEMPTS - 1)
+        with patch('cattube.core.deletion.delete_batch', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            self.run_job(FakeStorage(set()))
+        job = DeletionJob.objects.get(id=self.job.id)
+        self.assertIsNotNone(job.failed_at)
+        self.assertIsNone(job.finished_at)
+
+    @patch('cattube.core.views.do_deletion_job')
+    def test_reset_skips_videos_being_deleted(self, do_deletion_job):
+        given_up = DeletionJob.objects.create(failed_at=timezone.now())
+        Video.objects.filter(id=self.videos[0].id).update(deletion_job=given_up)
+        free = Video.objects.create(title='free', user=self.user, video='videos/free.mp4')
+        self.client.force_login(self.user)
+
+        self.client.get('/reset')
+
+        reset_job = DeletionJob.objects.get(reset=True)
+        do_deletion_job.assert_called_once_with(reset_job.id)
+        self.assertEqual(reset_job.total, 2)
+        self.assertEqual(set(reset_job.videos.values_list('id', flat=True)), {self.videos[0].id, free.id})
+        self.assertEqual(set(self.job.videos.values_list('id', flat=True)), {self.videos[1].id, self.videos[2].id})
+
+
+class AddNewFilesTests(TestCase):
+    def test_one_sync_at_a_time(self):
+        user = User.objects.create(username='user')
+        with patch('cattube.core.tasks.sync_bucket') as sync_bucket:
+            # Page views while the first scan is queued don't start another
+            add_new_files(user)
+            add_new_files(user)
+            sync_bucket.assert_called_once_with(user.id)
+
+            # Once the interval has passed, they do
+            SyncState.objects.update(synced_at=timezone.now() - timedelta(seconds=BUCKET_SYNC_INTERVAL + 1))
+            add_new_files(user)
+            self.assertEqual(sync_bucket.call_count, 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+@patch('cattube.core.views.add_new_files')
+class VideoCardCacheTests(TestCase):
+    def test_edited_card_is_not_stale(self, add_new_files):
+        user = User.objects.create(username='user')
+        self.client.force_login(user)
+        video = create_videos(user, 1)[0]
+        self.assertContains(self.client.get('/'), 'video 0')
+
+        Video.objects.filter(id=video.id).update(title='renamed')
+        User.objects.filter(id=user.id).update(username='owner')
+
+        response = self.client.get('/')
+        self.assertContains(response, 'renamed')
+        self.assertContains(response, 'owner')
+
+
+def sign_notification(body, secret, timestamp=None):
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode('utf-8'), f'{timestamp}.'.encode('utf-8') + body, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+@patch('cattube.settings.TWELVE_LABS_WEBHOOK_SECRET', 'secret')
+@patch('cattube.core.api.handle_indexing_notification')
+class TwelveLabsNotificationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def notify(self, notification, signature=None):
+        body = json.dumps(notification).encode('utf-8')
+        headers = {} if signature is False else {'TL-Signature': signature or sign_notification(body, 'secret')}
+        return self.client.post('/api/indexing/notification', body, content_type='application/json', headers=headers)
+
+    def test_notification(self, handle_indexing_notification):
+        notification = {'type': 'index.task.ready', 'data': {'id': 'task1'}}
+        self.assertEqual(self.notify(notification).status_code, 204)
+        handle_indexing_notification.assert_called_once_with('task1')
+
+    def test_replay(self, handle_indexing_notification):
+        notification = {'type': 'index.task.ready', 'data': {'id': 'task1'}}
+        signature = sign_notification(json.dumps(notification).encode('utf-8'), 'secret')
+        self.assertEqual(self.notify(notification, signature).status_code, 204)
+        self.assertEqual(self.notify(notification, signature).status_code, 401)
+        handle_indexing_notification.assert_called_once_with('task1')
+
+    def test_bad_signatures(self, handle_indexing_notification):
+        notification = {'type': 'index.task.ready', 'data': {'id': 'task1'}}
+        body = json.dumps(notification).encode('utf-8')
+        for signature in [False, 'garbage', sign_notification(body, 'wrong'),
+                          sign_notification(body, 'secret', int(time.time()) - 3600)]:
+            self.assertEqual(self.notify(notification, signature).status_code, 401, signature)
+        handle_indexing_notification.assert_not_called()
+
+    def test_invalid_notifications(self, handle_indexing_notification):
+        for notification in [[], 'task1', {'data': 'task1'}, {'data': {'id': 1}}, {'data': {}}]:
+            self.assertEqual(self.notify(notification).status_code, 400, notification)
+        handle_indexing_notification.assert_not_called()
+
+
+class KeysetPaginatorTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='user')
+        # Several videos share each upload time, so the ids have to break the ties
+        uploaded_at = timezone.now().replace(microsecond=123456)
+        for i in range(8):
+            Video.objects.create(title=f'video {i}', user=user, uploaded_at=uploaded_at - timedelta(seconds=i // 3))
+        self.ordered = list(Video.objects.order_by('-uploaded_at', '-id').values_list('id', flat=True))
+        self.paginator = KeysetPaginator(Video.objects.all(), 3)
+
+    def test_cursor_round_trip(self):
+        video = Video.objects.first()
+        self.assertEqual(parse_cursor(make_cursor(video)), (video.uploaded_at, video.id))
+        for cursor in ['', 'nonsense', '20260101.x', '20261301000000000000.1']:
+            with self.assertRaises(InvalidPage):
+                parse_cursor(cursor)
+
+    def test_forwards(self):
+        page = self.paginator.page()
+        self.assertFalse(page.has_previous())
+        ids = [video.id for video in page]
+        while page.has_next():
+            page = self.paginator.page(after=page.next_cursor())
+            self.assertTrue(page.has_previous())
+            ids += [video.id for video in page]
+        self.assertEqual(ids, self.ordered)
+
+    def test_backwards(self):
+        page = self.paginator.page(last=True)
+        self.assertFalse(page.has_next())
+        ids = [video.id for video in page]
+        while page.has_previous():
+            page = self.paginator.page(before=page.previous_cursor())
+            self.assertTrue(page.has_next())
+            ids = [video.id for video in page] + ids
+        # Every video, in order, ending on a full first page, which may repeat some of the videos on the page after it
+        self.assertEqual(list(dict.fromkeys(ids)), self.ordered)
+        self.assertEqual([video.id for video in page], self.ordered[:3])
+
+    def test_back_to_first_page(self):
+        # Going back from the second page gives a full first page, even though the last page is short
+        second = self.paginator.page(after=self.paginator.page().next_cursor())
+        first = self.paginator.page(before=second.previous_cursor())
+        self.assertEqual([video.id for video in first], self.ordered[:3])
+        self.assertFalse(first.has_previous())
+
+
+def latency_count():
+    histogram = metrics._histograms.get(('queue_latency_seconds', (('queue', DEFAULT_QUEUE),)))
+    return sum(histogram[1]) if histogram else 0
+
+
+class QueueLatencyTests(TestCase):
+    def setUp(self):
+        self.huey = MemoryHuey(utc=True)
+        self.huey.signal(signals.SIGNAL_ENQUEUED)(record_enqueue)
+        self.huey.signal(signals.SIGNAL_EXECUTING)(lambda signal, task: record_latency(DEFAULT_QUEUE, task))
+        self.calls = []
+
+        # Like queues.db_task(), without the database connection handling
+        @self.huey.task()
+        @timed
+        def timed_task(value):
+            self.calls.append(value)
+        timed_task.task_class.timed = True
+        self.timed_task = timed_task
+
+        @self.huey.task()
+        def untimed_task(value):
+            self.calls.append(value)
+        self.untimed_task = untimed_task
+
+    def test_enqueue_time_stripped(self):
+        self.timed_task(1)
+        task = self.huey.dequeue()
+        self.assertAlmostEqual(task.kwargs[ENQUEUED_AT], time.time(), delta=5)
+        before = latency_count()
+        # The task function doesn't take the enqueue time, so this would fail if it were passed through
+        self.huey.execute(task)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(latency_count(), before + 1)
+
+    def test_untimed_task(self):
+        self.untimed_task(1)
+        task = self.huey.dequeue()
+        self.assertNotIn(ENQUEUED_AT, task.kwargs)
+        before = latency_count()
+        self.huey.execute(task)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(latency_count(), before)
+
+    def test_slow_task_logged(self):
+        self.timed_task(1)
+        task = self.huey.dequeue()
+        with patch('cattube.core.queues.time', return_value=time.time() + QUEUE_LATENCY_WARNING + 10), \
+                self.assertLogs('cattube.core.queues', 'WARNING') as logs:
+            self.huey.execute(task)
+        self.assertGreater(logs.records[0].latency, QUEUE_LATENCY_WARNING)
+
+    def test_scheduled_task_waits_from_eta(self):
+        self.timed_task.schedule((1,), delay=3600)
+        task = self.huey.dequeue()
+        # Picked up 5 seconds after its eta: the hour before the eta isn't counted
+        with patch('cattube.core.queues.time', return_value=time.time() + 3605), \
+                patch('cattube.core.queues.metrics.observe') as observe:
+            self.huey.execute(task, task.eta + timedelta(seconds=5))
+        self.assertEqual(self.calls, [1])
+        name, latency = observe.call_args_list[0].args
+        self.assertEqual(name, 'queue_latency_seconds')
+        self.assertAlmostEqual(latency, 5, delta=2)
+
+
+class GetQueueTests(TestCase):
+    # get_queue() caches the queues, and registers signal handlers on them, so these call the uncached function
+
+    @patch('cattube.core.queues.HUEY_QUEUES', {})
+    def test_queue_without_consumer(self):
+        self.assertIs(get_queue.__wrapped__('polling'), djhuey.HUEY)
+
+    @patch('cattube.core.queues.HUEY_QUEUES', {'polling': {'workers': 4}})
+    def test_queue_with_consumer(self):
+        queue = get_queue.__wrapped__('polling')
+        self.assertIsNot(queue, djhuey.HUEY)
+        self.assertEqual(queue.name, f'{djhuey.HUEY.name}-polling')
+
+    def test_unknown_queue(self):
+        with self.assertRaises(ValueError):
+            get_queue.__wrapped__('nonsense')
+
+
+# A sample line, or a TYPE comment, in the Prometheus text format
+PROMETHEUS_LINE = re.compile(r'^(# TYPE [a-zA-Z_:][\w:]* (counter|histogram|gauge)|'
+                             r'[a-zA-Z_:][\w:]*(\{[a-zA-Z_]\w*="([^"\\\n]|\\.)*"(,[a-zA-Z_]\w*="([^"\\\n]|\\.)*")*\})? '
+                             r'([-+]?[\d.]+(e[-+]?\d+)?|[-+]?Inf|NaN))$')
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.metrics_dir.cleanup)
+        patcher = patch('cattube.core.metrics.METRICS_DIR', self.metrics_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save_snapshot(self, pid, data):
+        with open(os.path.join(self.metrics_dir.name, f'{pid}.json'), 'w') as f:
+            json.dump(data, f)
+
+    def saved_files(self):
+        # This process may have saved its own metrics too
+        return set(os.listdir(self.metrics_dir.name)) - {f'{os.getpid()}.json'}
+
+    def test_export(self):
+        metrics.increment('test_videos', status='ready')
+        metrics.observe('test_duration_seconds', 0.2, buckets=[0.1, 1], path='/say "hi"\\')
+        # Another process, the parent of this one, which is still running
+        self.save_snapshot(os.getppid(), {
+            'counters': [['test_videos', [['status', 'ready']], 2]],
+            'histograms': [['test_duration_seconds', [['path', '/say "hi"\\']], [0.1, 1], [1, 0, 1], 5.05]],
+        })
+        lines = metrics.export([('test_pending_tasks', {'queue': 'polling'}, 3)]).splitlines()
+
+        self.assertEqual([line for line in lines if not PROMETHEUS_LINE.match(line)], [])
+        self.assertIn('# TYPE cattube_test_videos_total counter', lines)
+        self.assertIn('cattube_test_videos_total{status="ready"} 3.0', lines)
+        labels = r'path="/say \"hi\"\\"'
+        self.assertIn('# TYPE cattube_test_duration_seconds histogram', lines)
+        self.assertIn(f'cattube_test_duration_seconds_bucket{{{labels},le="0.1"}} 1', lines)
+        self.assertIn(f'cattube_test_duration_seconds_bucket{{{labels},le="1"}} 2', lines)
+        self.assertIn(f'cattube_test_duration_seconds_bucket{{{labels},le="+Inf"}} 3', lines)
+        self.assertIn(f'cattube_test_duration_seconds_count{{{labels}}} 3', lines)
+        self.assertIn('cattube_test_pending_tasks{queue="polling"} 3.0', lines)
+        # Each metric has exactly one TYPE line
+        types = [line.split()[2] for line in lines if line.startswith('# TYPE')]
+        self.assertEqual(len(types), len(set(types)))
+
+    def test_exited_processes_pruned(self):
+        # A pid that isn't running: pids don't go this high
+        exited = 2 ** 30
+        self.assertFalse(metrics.is_running(exited))
+        for pid in [exited, exited + 1]:
+            self.save_snapshot(pid, {
+                'counters': [['test_exited', [], 1]],
+                'histograms': [['test_exited_seconds', [], [1], [1, 0], 0.5]],
+            })
+        self.save_snapshot(os.getppid(), {'counters': [['test_exited', [], 10]], 'histograms': []})
+
+        for _ in range(2):
+            lines = metrics.export().splitlines()
+            self.assertIn('cattube_test_exited_total 12.0', lines)
+            self.assertIn('cattube_test_exited_seconds_count 2', lines)
+            self.assertEqual(self.saved_files(), {metrics.EXITED_FILE, f'{os.getppid()}.json'})
+
+        # Another process exits, and its metrics are added to those already pruned
+        self.save_snapshot(exited, {'counters': [['test_exited', [], 100]], 'histograms': []})
+        self.assertIn('cattube_test_exited_total 112.0', metrics.export().splitlines())
+        self.assertEqual(self.saved_files(), {metrics.EXITED_FILE, f'{os.getppid()}.json'})
+
+    @patch('cattube.settings.METRICS_TOKEN', 'secret')
+    def test_endpoint_auth(self):
+        self.assertEqual(self.client.get('/api/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/api/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.client.get('/api/metrics', HTTP_AUTHORIZATION='secret').status_code, 401)
+
+        response = self.client.get('/api/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertIn('cattube_queue_pending_tasks{queue="default"} 0.0', response.content.decode().splitlines())
+
+        user = User.objects.create(username='user')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/api/metrics').status_code, 401)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get('/api/metrics').status_code, 200)
+
+    @patch('cattube.settings.METRICS_TOKEN', '')
+    def test_no_token_configured(self):
+        self.assertEqual(self.client.get('/api/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 401)
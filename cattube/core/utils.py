@@ -4,6 +4,7 @@ import json
 from datetime import timedelta, datetime, UTC
 from urllib.parse import urlunsplit, urlsplit
 
+from django.core.cache import cache
 from django.utils.safestring import mark_safe
 
 from cattube import settings
@@ -62,6 +63,49 @@ def verify_transloadit_signature(data):
     return calculated_signature == received_signature[algo_separator_index + 1:]
 
 
+def verify_twelve_labs_signature(signature_header, body):
+    """
+    Verify the TL-Signature header of a Twelve Labs webhook notification, of the form t=<timestamp>,v1=<signature>,
+    where the signature is the hex HMAC-SHA256 of '<timestamp>.<body>', keyed with the webhook secret. A signature is
+    only accepted once, so a notification can't be replayed while its timestamp is within the tolerance.
+    See https://docs.twelvelabs.io/docs/webhooks
+    """
+    if not settings.TWELVE_LABS_WEBHOOK_SECRET or not signature_header:
+        return False
+
+    try:
+        fields = dict(field.strip().split('=', 1) for field in signature_header.split(','))
+        timestamp = fields['t']
+        received_signature = fields['v1']
+        age = datetime.now(UTC).timestamp() - int(timestamp)
+    except (KeyError, ValueError):
+        return False
+
+    if abs(age) > settings.TWELVE_LABS_WEBHOOK_TOLERANCE:
+        return False
+
+    calculated_signature = hmac.new(settings.TWELVE_LABS_WEBHOOK_SECRET.encode('utf-8'),
+                                    f'{timestamp}.'.encode('utf-8') + body,
+                                    hashlib.sha256).hexdigest()
+
+    if not hmac.compare_digest(calculated_signature, received_signature):
+        return False
+
+    # The timestamp is accepted for TWELVE_LABS_WEBHOOK_TOLERANCE seconds either side of now
+    return cache.add(f'twelve-labs-signature:{received_signature}', True,
+                     timeout=2 * settings.TWELVE_LABS_WEBHOOK_TOLERANCE)
+
+
+def verify_metrics_token(authorization_header):
+    """
+    Verify the Authorization header of a request for the metrics, of the form Bearer <METRICS_TOKEN>.
+    """
+    if not settings.METRICS_TOKEN or not authorization_header:
+        return False
+
+    return hmac.compare_digest(authorization_header.encode('utf-8'), f'Bearer {settings.METRICS_TOKEN}'.encode('utf-8'))
+
+
 def create_signed_transloadit_options(notify_url):
     """
     Signature calculation from
@@ -1,24 +1,37 @@
-import json
+import logging
+from urllib.parse import urlencode
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth.decorators import login_required
-from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
 from django.core.files.storage import default_storage
-from django.http import HttpResponseRedirect
-from django.shortcuts import render
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from django.http import HttpResponseRedirect, Http404
 from django.urls import reverse, reverse_lazy
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
-from django.views.generic.base import View
-from django.views.generic.detail import DetailView, SingleObjectTemplateResponseMixin, SingleObjectMixin
+from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView
 from django.views.generic.edit import DeleteView
 from django.views.generic.list import ListView
 
-from cattube.settings import TWELVE_LABS_CLIENT, TWELVE_LABS_INDEX_ID, POLL_TRANSLOADIT, PAGE_SIZE
-from .forms import ResultForm
-from .models import Video, SearchResult, add_new_files
-from .tasks import poll_video_loading
+from cattube.settings import POLL_TRANSLOADIT, PAGE_SIZE, SEARCH_PAGE_LIMIT, VIDEO_CARD_CACHE_TIMEOUT, \
+    KEYSET_PAGINATION, VIDEO_COUNT_CACHE_TIMEOUT, DIRECT_UPLOAD, UPLOAD_PART_SIZE, UPLOAD_CONCURRENCY, \
+    RESULT_PAGE_MAX_AGE
+from .models import Video, DeletionJob, bump_counter
+from .pagination import KeysetPaginator
+from .search import LazySearchResults, INDEX_GENERATION, get_clips
+from .tasks import poll_video_loading, add_new_files, do_deletion_job
 from .utils import create_signed_transloadit_options
 
+logger = logging.getLogger(__name__)
+
+
+# Cache key for the number of videos in the list, with KEYSET_PAGINATION
+VIDEO_COUNT_CACHE_KEY = 'video_count'
+
 
 class VideoListView(ListView):
     model = Video
@@ -30,31 +43,65 @@ class VideoListView(ListView):
         Override default, so we can update the database with any new files in B2.
         """
         add_new_files(self.request.user)
-        return super().get_queryset()
+        # Hide videos that are waiting to be deleted, and fetch only what the template shows, with the username in the
+        # same query
+        return (super().get_queryset()
+                .filter(deletion_job__isnull=True)
+                .select_related('user')
+                .only('title', 'video', 'thumbnail', 'status', 'uploaded_at', 'user__username'))
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        With KEYSET_PAGINATION, page through the videos by position rather than page number.
+        """
+        if not KEYSET_PAGINATION:
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(queryset, page_size, count_key=VIDEO_COUNT_CACHE_KEY,
+                                    count_timeout=VIDEO_COUNT_CACHE_TIMEOUT)
+        try:
+            page = paginator.page(after=self.request.GET.get('after'),
+                                  before=self.request.GET.get('before'),
+                                  last='last' in self.request.GET)
+        except InvalidPage as e:
+            raise Http404(str(e))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        """
+        Sign the thumbnail URLs for the page in one go, rather than one at a time as the template renders them. Cards
+        that are already in the fragment cache don't need their URLs.
+        """
+        context = super().get_context_data(**kwargs)
+        keys = {make_template_fragment_key('video_card', video_card_key(video)): video
+                for video in context['object_list']}
+        cached = cache.get_many(keys.keys())
+        default_storage.urls([video.thumbnail.name for key, video in keys.items()
+                              if key not in cached and video.thumbnail])
+        context['card_cache_timeout'] = VIDEO_CARD_CACHE_TIMEOUT
+        context['keyset_pagination'] = KEYSET_PAGINATION
+        return context
 
 
-def delete_page(page):
-    for video in page:
-        print(f'Deleting {video.id} from index')
-        TWELVE_LABS_CLIENT.index.video.delete(TWELVE_LABS_INDEX_ID, video.id)
+def video_card_key(video):
+    """
+    Values that the video's card in video_list.html is cached on: everything the card shows. These must match the
+    {% cache %} tag's arguments.
+    """
+    return [video.id, video.status, video.video.name, video.thumbnail.name, video.title, video.user.username,
+            video.uploaded_at]
 
-def delete_videos():
-    videos = TWELVE_LABS_CLIENT.index.video.list_pagination(TWELVE_LABS_INDEX_ID)
-    # Strange iterator logic...
-    delete_page(videos.data)
-    while True:
-        try:
-            delete_page(next(videos))
-        except StopIteration:
-            break
 
 @method_decorator(login_required, name='dispatch')
 class VideoResetView(ListView):
     def get(self, request, *args, **kwargs):
-        # Delete videos from TwelveLabs
-        delete_videos()
-        # Delete videos from the database
-        Video.objects.all().delete()
+        # Start a background job to delete videos from TwelveLabs and the database, leaving the files in B2. Videos that
+        # another job is still deleting are left to it, but those in jobs that have been given up on are taken over.
+        job = DeletionJob.objects.create(delete_files=False, reset=True)
+        job.total = Video.objects.filter(Q(deletion_job__isnull=True) | Q(deletion_job__failed_at__isnull=False)) \
+            .update(deletion_job=job)
+        job.save(update_fields=['total'])
+        do_deletion_job(job.id)
         # Redirect to home
         return HttpResponseRedirect(reverse('home'))
 
@@ -66,88 +113,64 @@ class VideoSearchView(ListView):
 
     def get_queryset(self):
         """
-        Search Twelve Labs for videos matching the query
+        Search Twelve Labs for videos matching the query. The results are only retrieved as the paginator needs them.
         """
         query = self.request.GET.get("query", None)
-
-        results = TWELVE_LABS_CLIENT.search.query(
-            TWELVE_LABS_INDEX_ID,
-            ["visual", "audio"],
-            query_text=query,
-            group_by="video",
-            threshold="high"
-        )
-
-        # Search results may be in multiple pages, so we need to loop until we're done retrieving them
-        search_data = results.data
-        print(f"First page's data: {search_data}")
-
-        search_results = []
-        while True:
-            # Do a database query to get the videos for each page of results
-            video_ids = [group.id for group in search_data]
-            videos = Video.objects.filter(video_id__in=video_ids)
-            for group in search_data:
-                try:
-                    search_results.append(SearchResult(video=videos.get(video_id__exact=group.id),
-                                                       clip_count=len(group.clips),
-                                                       clips=group.clips.model_dump_json()))
-                except self.model.DoesNotExist:
-                    # There is a video in TwelveLabs, but no corresponding row in the database.
-                    # Just report it and carry on.
-                    print(f'Video {group.id} is in TwelveLabs, but not in the database')
-
-            # Is there another page?
-            try:
-                search_data = next(results)
-                print(f"Next page's data: {search_data}")
-            except StopIteration:
-                print("There is no next page in search result")
-                break
-
-        return search_results
+        return LazySearchResults(query) if query else []
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['query'] = self.request.GET.get("query", None)
+        context['search_id'] = getattr(self.object_list, 'search_id', None)
+        # Sign the thumbnail URLs for the page in one go
+        default_storage.urls([result.video.thumbnail.name for result in context['object_list']
+                              if result.video.thumbnail])
         return context
 
 
-class VideoResultView(SingleObjectTemplateResponseMixin, SingleObjectMixin, View):
+class AsyncVideoSearchView(VideoSearchView):
     """
-    Drill down into a single search result. Parameters are POSTed to this page, since
-    they include the search results for this video.
+    VideoSearchView for the ASGI entry point. The pages of results that the request needs are retrieved from Twelve
+    Labs without blocking, so slow searches don't tie up a worker, then the rest of the request runs as usual.
     """
-    model = Video
-    template_name = "core/video_result.html"
-    pk_url_kwarg = 'id'
+    results = None
 
-    def get_object(self, queryset=None):
-        """
-        Get the object from the "id" form parameter, referenced here as "pk"
-        """
-        if queryset is None:
-            queryset = self.get_queryset()
-        return queryset.get(pk=self.pk)
+    async def get(self, request, *args, **kwargs):
+        query = request.GET.get("query", None)
+        if query:
+            self.results = await sync_to_async(LazySearchResults)(query)
+            page = request.GET.get(self.page_kwarg)
+            number = int(page) if page and page.isdigit() else 1
+            await self.results.aget_page((number * PAGE_SIZE - 1) // SEARCH_PAGE_LIMIT + 1)
+        return await sync_to_async(super().get)(request, *args, **kwargs)
 
-    # noinspection PyAttributeOutsideInit
-    def post(self, request):
-        """
-        Handle the POST, using a Form to extract the parameters, and populate the context with the search
-        results (clips), query, and all the video data.
-        """
-        form = ResultForm(request.POST)
-        if not form.is_valid():
-            raise ValidationError("Invalid form", code="invalid")
+    def get_queryset(self):
+        return self.results if self.results is not None else super().get_queryset()
 
-        self.pk = form.cleaned_data['id']
-        self.object = self.get_object()
 
-        context = self.get_context_data(object=self.object)
-        context['clips'] = json.loads(form.cleaned_data['clips'])
-        context['query'] = form.cleaned_data['query']
+class VideoResultView(DetailView):
+    """
+    Drill down into a single search result. The video's clips are retrieved from the cached search results, by search
+    id and page number, so that the page is a plain GET that the browser can cache.
+    """
+    model = Video
+    template_name = "core/video_result.html"
+    pk_url_kwarg = 'video_id'
 
-        return render(request, self.template_name, context)
+    # noinspection PyAttributeOutsideInit
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        query = request.GET.get('query', '')
+        clips = get_clips(kwargs['search_id'], kwargs['page'], self.object.video_id)
+        if clips is None:
+            # The results have expired from the cache, so search again, at the page the result was on
+            page = (kwargs['page'] - 1) * SEARCH_PAGE_LIMIT // PAGE_SIZE + 1
+            return HttpResponseRedirect(f"{reverse('search')}?{urlencode({'query': query, 'page': page})}")
+
+        response = self.render_to_response(self.get_context_data(object=self.object, clips=clips, query=query))
+        # The page has the username in it, and a presigned URL for the video
+        patch_cache_control(response, private=True, max_age=RESULT_PAGE_MAX_AGE)
+        return response
 
 
 class VideoDetailView(DetailView):
@@ -169,11 +192,14 @@ class VideoCreateView(CreateView):
 
     def get_context_data(self, **kwargs):
         """
-        Add the TransloadIt params and signature to the context
+        Add the TransloadIt params and signature to the context, or, for direct uploads, the upload settings
         """
         context = super().get_context_data(**kwargs)
-        notify_url = None if POLL_TRANSLOADIT else self.request.build_absolute_uri(reverse('notification'))
-        context.update(create_signed_transloadit_options(notify_url))
+        if DIRECT_UPLOAD:
+            context.update(direct_upload=True, upload_part_size=UPLOAD_PART_SIZE, upload_concurrency=UPLOAD_CONCURRENCY)
+        else:
+            notify_url = None if POLL_TRANSLOADIT else self.request.build_absolute_uri(reverse('notification'))
+            context.update(create_signed_transloadit_options(notify_url))
         return context
 
     # noinspection PyAttributeOutsideInit
@@ -197,10 +223,12 @@ class VideoDeleteView(DeleteView):
         Delete the file from B2 as well as the object from the database
         """
         video_name = self.get_object().video.name
-        print(f'Deleting: {video_name}')
+        logger.info('Deleting', extra={'file': video_name})
         default_storage.delete(video_name)
-        print(f'Deleted: {video_name}')
-        return super().form_valid(form)
+        logger.info('Deleted', extra={'file': video_name})
+        response = super().form_valid(form)
+        bump_counter(INDEX_GENERATION)
+        return response
 
     def get_success_url(self):
         return reverse('home')
@@ -1,6 +1,8 @@
 import os
+import tempfile
 
 # Never put credentials in your code!
+from django.utils.functional import SimpleLazyObject
 from dotenv import load_dotenv
 from twelvelabs import TwelveLabs
 
@@ -71,6 +73,40 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'cattube.wsgi.application'
+ASGI_APPLICATION = 'cattube.asgi.application'
+
+# Use the async versions of views that wait on remote services. cattube/asgi.py turns this on; under WSGI, each async
+# view would need an event loop of its own.
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', 'false').lower() == 'true'
+
+# Search results are cached separately from other data, so they can use a different backend. The result pages and
+# links are served from the cached results, so every web app process must share the cache: they are kept in files in
+# SEARCH_CACHE_DIR, so that the processes on this machine share them. Entries expire after TIMEOUT seconds, but their
+# files are only removed when they are next read, or when the cache is culled: once there are MAX_ENTRIES files, adding
+# another removes a random third of them, however recently they were used. Nothing else removes the files, so the
+# directory never holds more than MAX_ENTRIES results. If the web app runs on more than one machine, use a backend they
+# all share, such as DatabaseCache or RedisCache.
+SEARCH_CACHE_DIR = os.environ.get('SEARCH_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'cattube-search'))
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': SEARCH_CACHE_DIR,
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+    # Results of checks that call remote services are kept on disk, so that every process on the machine shares them
+    'checks': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'cattube-checks'),
+    },
+}
+SEARCH_CACHE = 'search'
+CHECKS_CACHE = 'checks'
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
@@ -82,6 +118,30 @@ DATABASES = {
     }
 }
 
+# DATABASE_PROFILE selects how SQLite is tuned:
+#   'default': SQLite's own defaults, with a new connection per request
+#   'production': tuned for the web app and Huey workers sharing the database. WAL mode lets readers carry on while a
+#                 write is in progress, and only syncs to disk at checkpoints; writers wait for the lock rather than
+#                 failing with "database is locked"; connections are kept open between requests.
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'default')
+
+# PRAGMA statements run on each new SQLite connection
+SQLITE_PRAGMAS = {}
+
+if DATABASE_PROFILE == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+    })
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # Milliseconds
+        'busy_timeout': 20000,
+        # Bytes
+        'mmap_size': 256 * 1024 * 1024,
+    }
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Internationalization
@@ -117,6 +177,22 @@ AWS_S3_OBJECT_PARAMETERS = {
 # Lifetime for presigned URLs
 AWS_QUERYSTRING_EXPIRE = 86400
 
+# Number of presigned URLs each process keeps in memory, in front of the default cache
+STORAGE_URL_CACHE_SIZE = 10000
+
+# Lifetime of a rendered video card on the list page. Cards embed a presigned thumbnail URL, which may already be up to
+# three quarters of the way through its lifetime when the card is rendered, so this must be well under a quarter of it.
+VIDEO_CARD_CACHE_TIMEOUT = AWS_QUERYSTRING_EXPIRE // 8
+
+# Sign URLs as of the start of a SIGNED_URL_WINDOW second window, rather than the current time, so that every process
+# creates the same URL for a file until the window ends, and browsers and CDNs can cache the file
+STABLE_SIGNED_URLS = os.environ.get('STABLE_SIGNED_URLS', 'false').lower() == 'true'
+# A URL is handed out until the end of its window, so it always has at least three quarters of its lifetime left, as
+# with cached URLs that are signed as of the current time
+SIGNED_URL_WINDOW = AWS_QUERYSTRING_EXPIRE // 4
+# Cache-Control header that B2 sends with files fetched by stable URLs
+SIGNED_URL_CACHE_CONTROL = f'public, max-age={AWS_QUERYSTRING_EXPIRE}'
+
 STATIC_S3_REGION_NAME = os.environ['STATIC_S3_REGION_NAME']
 STATIC_STORAGE_BUCKET_NAME = os.environ['STATIC_STORAGE_BUCKET_NAME']
 
@@ -150,20 +226,210 @@ STORAGES = {
 TRANSLOADIT_KEY = os.environ['TRANSLOADIT_KEY']
 TRANSLOADIT_SECRET = os.environ['TRANSLOADIT_SECRET']
 TRANSLOADIT_TEMPLATE_ID = os.environ['TRANSLOADIT_TEMPLATE_ID']
-POLL_TRANSLOADIT = True
-
-HUEY = {
-    'huey_class': 'huey_django_orm.storage.DjangoORMHuey',
-    'immediate': False,
+# Poll Transloadit for the status of uploads, rather than having it notify the web app, which needs the web app to be
+# reachable from the internet
+POLL_TRANSLOADIT = os.environ.get('POLL_TRANSLOADIT', 'true').lower() == 'true'
+
+# Upload videos from the browser straight to B2, in parts, in parallel, rather than through Transloadit. The bucket's
+# CORS rules must allow PUT requests from the web app and expose the ETag header.
+DIRECT_UPLOAD = os.environ.get('DIRECT_UPLOAD', 'false').lower() == 'true'
+# Smallest part size for direct uploads; B2 allows up to 10,000 parts of between 5 MB and 5 GB. Larger files use
+# larger parts.
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+# Number of parts the browser uploads at a time
+UPLOAD_CONCURRENCY = 6
+# Lifetime of the presigned URL for each part
+UPLOAD_PART_URL_EXPIRE = 3600
+# Minimum and maximum number of seconds between retrieving the status of an upload, how long to wait when Transloadit
+# says we're retrieving it too often, and how long to keep trying
+TRANSLOADIT_POLL_INTERVAL = 1
+TRANSLOADIT_MAX_POLL_INTERVAL = 30
+TRANSLOADIT_RATE_LIMIT_DELAY = 60
+TRANSLOADIT_POLL_TIMEOUT = 6 * 60 * 60
+
+# HUEY_BACKEND selects where Huey keeps its queues:
+#   'orm': in the app's database, via the Django ORM
+#   'sqlite': in a separate SQLite database, in WAL mode, so that the consumers polling the queues don't lock the
+#             app's database
+#   'memory': nowhere; tasks run immediately, in process. Useful for local development without a consumer.
+HUEY_BACKEND = os.environ.get('HUEY_BACKEND', 'orm')
+HUEY_BACKENDS = {
+    'orm': {
+        'huey_class': 'huey_django_orm.storage.DjangoORMHuey',
+        'immediate': False,
+    },
+    'sqlite': {
+        'huey_class': 'huey.SqliteHuey',
+        'filename': os.environ.get('HUEY_SQLITE_FILENAME', os.path.join(BASE_DIR, 'huey.sqlite3')),
+        'immediate': False,
+    },
+    'memory': {
+        'huey_class': 'huey.MemoryHuey',
+        'immediate': True,
+    },
+}
+HUEY = HUEY_BACKENDS[HUEY_BACKEND]
+
+# Long-running tasks can have their own queues, so they don't hold up everything else. Each queue needs its own
+# consumer, run with 'manage.py run_huey_queue <name>', with these consumer options.
+HUEY_QUEUE_OPTIONS = {
+    # Polling Twelve Labs and Transloadit for status
+    'polling': {'workers': 4},
+    # Copying thumbnails to B2
+    'thumbnails': {'workers': 2},
+    # Deleting videos
+    'deletion': {'workers': 1},
+}
+# The queues that have their own consumer, a comma-separated list of names from HUEY_QUEUE_OPTIONS. Tasks for the
+# other queues go on the default queue, so that 'manage.py run_huey' alone runs every task.
+HUEY_QUEUES = {name: HUEY_QUEUE_OPTIONS[name] for name in os.environ.get('HUEY_QUEUES', '').split(',') if name}
+
+# Report tasks that wait longer than this many seconds in a queue before a worker picks them up
+QUEUE_LATENCY_WARNING = 30
+
+# Each process keeps its own metrics, and saves them to a file in METRICS_DIR every METRICS_FLUSH_INTERVAL seconds, so
+# that the metrics endpoint, api/metrics, can add up those of every web app worker and Huey consumer on the machine
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'cattube-metrics'))
+METRICS_FLUSH_INTERVAL = 10
+# Bearer token that Prometheus presents to the metrics endpoint. Without it, only staff users can see the metrics.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Histogram buckets, in seconds, for calls to B2, Twelve Labs and Transloadit, and for Huey tasks
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Histogram buckets, in seconds, for database queries
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+# Histogram buckets, in seconds, for the time videos spend in each stage: uploading, then each indexing status
+STAGE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 43200, 86400)
+
+# Log messages from loops over videos and tasks are at DEBUG level, and only LOG_SAMPLE_RATE of them are kept, so that
+# turning on DEBUG doesn't swamp the logs when there are thousands of videos
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.1'))
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'sample': {
+            '()': 'cattube.core.logs.SampleFilter',
+            'rate': LOG_SAMPLE_RATE,
+        },
+    },
+    'formatters': {
+        'key_value': {
+            '()': 'cattube.core.logs.KeyValueFormatter',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'filters': ['sample'],
+            'formatter': 'key_value',
+        },
+    },
+    'loggers': {
+        'cattube': {
+            'handlers': ['console'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+    },
 }
 
 VIDEOS_PATH = 'video'
 THUMBNAILS_PATH = 'thumbnail'
 
+# Number of videos to delete at a time; B2 can delete up to 1000 files in a single request
+DELETION_BATCH_SIZE = 500
+# Deletion jobs that are interrupted, or that finish with videos that could not be deleted, are run again
+# DELETION_RETRY_DELAY seconds after they last started, doubling after each run, up to DELETION_MAX_ATTEMPTS runs in
+# all, after which they are marked as failed
+DELETION_RETRY_DELAY = 300
+DELETION_MAX_ATTEMPTS = 5
+
+# Scan the bucket for new videos in a Huey task rather than in the list page request
+BUCKET_SYNC_IN_BACKGROUND = True
+# Minimum number of seconds between scans of the bucket for new videos
+BUCKET_SYNC_INTERVAL = 60
+
+# 'manage.py ingest_bucket' lists this many files per request, and creates videos for them this many at a time
+INGEST_PAGE_SIZE = 1000
+INGEST_BATCH_SIZE = 500
+# Default number of videos per second that 'manage.py ingest_bucket --index' schedules for indexing
+INGEST_INDEX_RATE = 1
+
+TWELVE_LABS_API_KEY = os.environ['TWELVE_LABS_API_KEY']
 TWELVE_LABS_INDEX_ID = os.environ['TWELVE_LABS_INDEX_ID']
+# How long a successful check that the API key and index ID are valid lasts before the next command start repeats it
+TWELVE_LABS_CHECK_TIMEOUT = 3600
+# Commands that don't need to reach Twelve Labs, so don't check the index when they start. The tests and benchmarks use
+# a fake client.
+TWELVE_LABS_CHECK_SKIP_COMMANDS = ['migrate', 'makemigrations', 'showmigrations', 'collectstatic', 'createsuperuser',
+                                   'changepassword', 'shell', 'dbshell', 'run_huey', 'run_huey_queue', 'queue_stats',
+                                   'ingest_bucket', 'test', 'benchmark']
+# Maximum number of concurrent requests when creating indexing tasks, and the number of videos to update in the
+# database at a time
+TWELVE_LABS_CREATE_CONCURRENCY = 8
+TWELVE_LABS_CREATE_BATCH_SIZE = 100
+# Maximum number of concurrent requests when deleting videos from the index
+TWELVE_LABS_DELETE_CONCURRENCY = 8
+# Maximum number of Twelve Labs requests per second, and how many times to retry when rate limited anyway
+TWELVE_LABS_RATE_LIMIT = 10
+TWELVE_LABS_MAX_RETRIES = 5
+# Minimum and maximum number of seconds between retrieving the status of an indexing task
 TWELVE_LABS_POLL_INTERVAL = 1
-
-TWELVE_LABS_CLIENT = TwelveLabs(api_key=os.environ['TWELVE_LABS_API_KEY'])
+TWELVE_LABS_MAX_POLL_INTERVAL = 60
+# Maximum number of thumbnails to copy from Twelve Labs at a time, how many times to retry, and the timeout in seconds
+THUMBNAIL_CONCURRENCY = 8
+THUMBNAIL_MAX_RETRIES = 3
+THUMBNAIL_TIMEOUT = 30
+# While a video is being indexed, poll at this fraction of its duration
+TWELVE_LABS_INDEXING_POLL_RATIO = 0.05
+# How long each pass of the indexing task poller runs for. A new pass starts every minute.
+TWELVE_LABS_POLL_PASS_DURATION = 55
+# Secret for verifying Twelve Labs webhook notifications. When it's set, Twelve Labs tells us when indexing tasks are
+# done, so, after the first check, we only sweep for missed notifications every TWELVE_LABS_SWEEP_INTERVAL seconds.
+TWELVE_LABS_WEBHOOK_SECRET = os.environ.get('TWELVE_LABS_WEBHOOK_SECRET')
+TWELVE_LABS_SWEEP_INTERVAL = 900
+# Reject webhook notifications signed more than this many seconds ago, so they can't be replayed. Within that time, the
+# default cache remembers the signatures it has seen, so with more than one web process, it needs to be a shared
+# backend.
+TWELVE_LABS_WEBHOOK_TOLERANCE = 300
+
+
+def create_twelve_labs_client():
+    """
+    Twelve Labs client that records the duration of each call in the metrics.
+    """
+    # Imported here, since the metrics module needs these settings
+    from twelvelabs.resource import APIResource
+    from cattube.core.metrics import instrument
+    return instrument(TwelveLabs(api_key=TWELVE_LABS_API_KEY), 'twelve_labs', resources=(APIResource,))
+
+
+# Created on first use, rather than when the settings are loaded, so that processes that never call Twelve Labs don't
+# pay for it. All the threads in a process share the one client, and its connection pool.
+TWELVE_LABS_CLIENT = SimpleLazyObject(create_twelve_labs_client)
+# Connection pool size for the async Twelve Labs client, used by async views
+TWELVE_LABS_ASYNC_MAX_CONNECTIONS = 20
 
 # How many videos to show in list pages
 PAGE_SIZE = 15
+# How many search results to retrieve from Twelve Labs at a time. Matching PAGE_SIZE means each page of results in the
+# UI needs a single request.
+SEARCH_PAGE_LIMIT = PAGE_SIZE
+# How long the browser may cache a search result page. It contains a presigned URL for the video, so this must be well
+# under a quarter of AWS_QUERYSTRING_EXPIRE; see VIDEO_CARD_CACHE_TIMEOUT.
+RESULT_PAGE_MAX_AGE = 3600
+# Page through the video list with first/previous/next/last links that seek by upload time, rather than numbered pages,
+# so that deep pages are as fast as the first one however large the library is
+KEYSET_PAGINATION = os.environ.get('KEYSET_PAGINATION', 'false').lower() == 'true'
+# How long the total number of videos shown with KEYSET_PAGINATION may be out of date. Set to 0 to count every time.
+VIDEO_COUNT_CACHE_TIMEOUT = 60
+
+# Under ASGI, how long a request for status changes waits for one to happen, and how often it checks, in seconds.
+# Under WSGI, a waiting request would occupy a worker, so the request returns straight away, and the browser asks again
+# every STATUS_POLL_INTERVAL seconds.
+STATUS_LONG_POLL_TIMEOUT = 20
+STATUS_LONG_POLL_INTERVAL = 0.5
+STATUS_POLL_INTERVAL = 5
+# How long to keep entries in the status change journal, in seconds
+STATUS_CHANGE_RETENTION = 86400
@@ -24,7 +24,8 @@ function getToken(name) {
 }
 
 function updateIndexUI(tasks) {
-  let done = true;
+  // Returns the ids of the videos that have finished indexing
+  const finished = [];
   for (const task of tasks) {
     const divVideo = document.querySelector(`div[data-videoid="${task.id}"]`);
     if (divVideo) {
@@ -33,49 +34,67 @@ function updateIndexUI(tasks) {
       if (task.status === 'Ready') {
         divThumbnail.dataset.status = "";
         if (imgThumbnail.classList.contains("tn-small")) {
-          // On list page - swap out individual image
-          imgThumbnail.src = task.thumbnail;
+          // On list page - swap out individual image. The thumbnail may arrive a moment after the video is ready, in
+          // which case it shows up on the next page load.
+          if (task.thumbnail) {
+            imgThumbnail.src = task.thumbnail;
+          }
           divVideo.querySelector('input[type=checkbox]')?.remove();
         } else {
           // On detail page - just reload rather than messing with the DOM
           window.location.reload();
         }
+        finished.push(String(task.id));
       } else {
         divThumbnail.dataset.status = task.status;
-        done = false;
+        if (task.status === 'Failed' || task.status === 'Error') {
+          finished.push(String(task.id));
+        }
       }
     }
   }
-  return done;
+  return finished;
 }
 
-function getVideoStatus(tasks, callback) {
-  console.log("Getting status");
-  fetch('/api/videos/status', {
-    method:'POST',
-    headers:{
+function watchVideoStatus(ids, callback, cursor) {
+  // Wait for changes to the videos, passing them to the callback, which returns the ids of any videos that we no
+  // longer need to watch. The server responds when there are changes since the cursor, or after a timeout, and says
+  // how long to wait before asking again. The ids go in the body, since there may be too many for a URL.
+  const data = { ids: ids };
+  if (cursor !== undefined) {
+    data.since = cursor;
+  }
+  fetch('/api/videos/changes', {
+    method: 'POST',
+    headers: {
       'Content-Type': 'application/json',
       'X-CSRFToken': getToken('csrftoken'),
     },
-    body:JSON.stringify(tasks)
+    body: JSON.stringify(data)
   }).then((response) => {
-    console.log('status:', response.status);
+    if (!response.ok) {
+      throw new Error(`status: ${response.status}`);
+    }
     return response.json();
-  }).then((tasks) => {
-    console.log('tasks:', tasks);
-    let done = callback(tasks);
-    if (!done) {
+  }).then((data) => {
+    console.log('changes:', data);
+    const finished = callback(data.videos);
+    ids = ids.filter(id => !finished.includes(id));
+    if (ids.length > 0) {
       setTimeout(() => {
-        getVideoStatus(tasks, callback);
-      }, 1000);
+        watchVideoStatus(ids, callback, data.cursor);
+      }, (data.poll_interval || 0) * 1000);
     }
+  }).catch((error) => {
+    console.log('Error getting changes:', error);
+    setTimeout(() => {
+      watchVideoStatus(ids, callback, cursor);
+    }, 5000);
   });
 }
 
 function listenForStatusUpdates(tasks) {
-  setTimeout(() => {
-    getVideoStatus(tasks, updateIndexUI);
-  }, 1000);
+  watchVideoStatus(tasks.map(task => String(task.id)), updateIndexUI);
 }
 
 function listenForTasks() {
@@ -154,7 +173,8 @@ function selectedVideosOperation(operation, callback) {
   videosOperation(data, operation, callback);
 }
 
-function checkboxClicked(videoCount) {
+function checkboxClicked() {
+  const videoCount = document.querySelector("#grid").dataset.count;
   const checked = document.querySelectorAll("input[type=checkbox]:checked");
   const unchecked = document.querySelectorAll("input[type=checkbox]:not(:checked)");
 
@@ -197,18 +217,14 @@ function playClip(start, end) {
   };
 }
 
-async function pollForVideo(id) {
-  console.log(`Polling for ${id}`)
-  const response = await fetch(`/api/videos/${id}`)
-      .then(response => {
-        if (response.ok) {
-          return response.json();
-        }
-      });
-
-  if (response?.video) {
-    location.reload();
-  }
+function listenForUpload(id) {
+  watchVideoStatus([id], (videos) => {
+    if (videos.some(video => video.original)) {
+      location.reload();
+      return [id];
+    }
+    return [];
+  });
 }
 
 function hms(seconds) {
@@ -1,8 +1,81 @@
 import hashlib
-from urllib.parse import urlencode
+import hmac
+import threading
+from collections import OrderedDict
+from datetime import datetime, UTC
+from time import perf_counter, time
+from urllib.parse import urlencode, urlsplit, quote
 
 from django.core.cache import cache
 from storages.backends.s3 import S3Storage
+from storages.utils import clean_name
+
+from cattube.core import metrics
+from cattube.settings import STORAGE_URL_CACHE_SIZE, STABLE_SIGNED_URLS, SIGNED_URL_WINDOW, SIGNED_URL_CACHE_CONTROL
+
+# Parameters that we can sign ourselves, with their query string names. They override the response's headers.
+RESPONSE_PARAMETERS = {
+    'ResponseCacheControl': 'response-cache-control',
+    'ResponseContentDisposition': 'response-content-disposition',
+    'ResponseContentEncoding': 'response-content-encoding',
+    'ResponseContentLanguage': 'response-content-language',
+    'ResponseContentType': 'response-content-type',
+    'ResponseExpires': 'response-expires',
+}
+
+
+class LocalCache:
+    """
+    Thread-safe in-process LRU cache, holding up to max_entries values, each with an expiry time in seconds since the
+    epoch. This saves a round trip to the shared cache for values that we've already seen in this process.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, expires_at):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+# noinspection PyUnusedLocal
+def start_call(model, context, **kwargs):
+    context['metrics'] = (model.name, perf_counter())
+
+
+# noinspection PyUnusedLocal
+def finish_call(http_response, context, **kwargs):
+    # A handler that answers before-call with a response of its own, such as botocore's Stubber, skips start_call()
+    if 'metrics' not in context:
+        return
+    operation, started_at = context['metrics']
+    # Not found is the usual answer when exists() checks for a file
+    failed = http_response.status_code >= 300 and http_response.status_code != 404
+    error = f'HTTP {http_response.status_code}' if failed else None
+    metrics.record_call('b2', operation, perf_counter() - started_at, error)
+
+
+# noinspection PyUnusedLocal
+def fail_call(exception, context, **kwargs):
+    if 'metrics' not in context:
+        return
+    operation, started_at = context['metrics']
+    metrics.record_call('b2', operation, perf_counter() - started_at, type(exception).__name__)
 
 
 class CachedS3Storage(S3Storage):
@@ -10,33 +83,273 @@ class CachedS3Storage(S3Storage):
     Cache signed URLs to avoid generating new ones every time we render a page. This allows the browser to cache
     thumbnail images etc.
     From https://stackoverflow.com/a/77668592/33905
+
+    URLs are cached in two tiers: an in-process LRU cache in front of the shared Django cache. Since the shared cache
+    is the source of truth, every process that shares it hands out the same URL for a file, and the browser can cache
+    it.
+
+    With STABLE_SIGNED_URLS, URLs are signed as of the start of a fixed time window rather than the current time, so
+    every process creates the same URL for a file until the end of the window, whether or not they share a cache, and
+    the URL asks B2 for a Cache-Control header, so that browsers and CDNs can cache the response.
     """
+    def __init__(self, **settings):
+        super().__init__(**settings)
+        self.local_cache = LocalCache(STORAGE_URL_CACHE_SIZE)
+        self.signing_key = (None, None)
+
+    def _create_session(self):
+        """
+        Record the duration of every call that boto3 makes to B2, whichever storage method it comes from.
+        """
+        session = super()._create_session()
+        session.events.register('before-call.s3', start_call)
+        session.events.register('after-call.s3', finish_call)
+        session.events.register('after-call-error.s3', fail_call)
+        return session
+
     def url(self, name, parameters=None, expire=None, http_method=None):
+        return self.urls([name], parameters=parameters, expire=expire, http_method=http_method)[name]
+
+    def urls(self, names, parameters=None, expire=None, http_method=None):
+        """
+        Get signed URLs for a number of files at once, returning a dict mapping name to URL. Names that are not in the
+        local cache are looked up in the shared cache with a single get_many(), and any that are not there either
+        are signed and stored with a single set_many().
+        """
         if expire is None:
             expire = self.querystring_expire  # noqa
 
         # Cache the result for 3/4 of the temp_url's lifetime.
         timeout = int(expire * 0.75)
 
-        # Specify a Cache-Control header for B2 to set in the response so that the browser will cache the image
-        # if parameters == None:
-        #     parameters = {}
-        # parameters['ResponseCacheControl'] = f'max-age={timeout}'
+        if STABLE_SIGNED_URLS and http_method in (None, 'GET'):
+            # Specify a Cache-Control header for B2 to set in the response so that the browser will cache the image
+            parameters = {'ResponseCacheControl': SIGNED_URL_CACHE_CONTROL, **(parameters or {})}
 
         params = "?{}".format(urlencode(parameters)) if parameters else ""
 
-        # Add a prefix to avoid conflicts with other apps
-        key = f"CachedS3Storage_{name}_{expire}_{params}_{http_method}"
-        key = hashlib.md5(key.encode()).hexdigest()
+        result = {}
+        local_keys = {}
+        for name in names:
+            local_key = (name, expire, params, http_method)
+            url = self.local_cache.get(local_key)
+            if url is not None:
+                result[name] = url
+            else:
+                local_keys[name] = local_key
+        if len(local_keys) == 0:
+            return result
 
-        # Look up the key in the cache
-        result = cache.get(key)
-        if result is not None:
+        if STABLE_SIGNED_URLS and self.can_sign_locally(parameters, http_method):
+            # Signing is cheaper than a round trip to the shared cache, and gives the same URL in every process
+            signed_at = int(time()) // SIGNED_URL_WINDOW * SIGNED_URL_WINDOW
+            for name, local_key in local_keys.items():
+                url = self.sign_url(name, parameters=parameters, expire=expire, http_method=http_method,
+                                    signed_at=signed_at)
+                result[name] = url
+                self.local_cache.set(local_key, url, signed_at + SIGNED_URL_WINDOW)
             return result
 
-        # No cached value exists, follow the usual logic
-        result = super().url(name, parameters=parameters, expire=expire, http_method=http_method)
+        # Add a prefix to avoid conflicts with other apps
+        keys = {}
+        for name in local_keys:
+            key = f"CachedS3Storage_{name}_{expire}_{params}_{http_method}"
+            keys[hashlib.md5(key.encode()).hexdigest()] = name
 
-        cache.set(key, result, timeout)
+        # Look up the keys in the shared cache. Each value is a (url, expires_at) tuple, so the local cache doesn't
+        # keep a URL for longer than the shared cache would.
+        cached = cache.get_many(keys.keys())
+        for key, value in cached.items():
+            url, expires_at = value
+            result[keys[key]] = url
+            self.local_cache.set(local_keys[keys[key]], url, expires_at)
+
+        # No cached value exists, follow the usual logic
+        new_values = {}
+        expires_at = time() + timeout
+        for key, name in keys.items():
+            if key not in cached:
+                url = self.sign_url(name, parameters=parameters, expire=expire, http_method=http_method)
+                result[name] = url
+                new_values[key] = (url, expires_at)
+                self.local_cache.set(local_keys[name], url, expires_at)
+        if len(new_values) > 0:
+            cache.set_many(new_values, timeout)
 
         return result
+
+    def can_sign_locally(self, parameters, http_method):
+        """
+        We only sign URLs ourselves in the simple case: a GET request for a file, optionally overriding response
+        headers, using path-style addressing, with static credentials. Anything else is left to boto3.
+        """
+        return (RESPONSE_PARAMETERS.keys() >= (parameters or {}).keys()
+                and http_method in (None, 'GET')
+                and self.querystring_auth
+                and not self.custom_domain
+                and self.endpoint_url
+                and self.region_name
+                and self.access_key
+                and self.secret_key
+                and not self.security_token
+                and self.signature_version in (None, 's3v4')
+                and self.addressing_style in (None, 'path'))
+
+    def sign_url(self, name, parameters=None, expire=None, http_method=None, signed_at=None):
+        """
+        Create a presigned URL. Generating a presigned URL with boto3 runs through its whole request pipeline, which
+        is relatively slow, so, where we can, we do the AWS Signature Version 4 query string signing ourselves.
+        signed_at, in seconds since the epoch, overrides the signing time; the URL expires expire seconds after it.
+        boto3 always signs as of the current time.
+        """
+        if not self.can_sign_locally(parameters, http_method):
+            return super().url(name, parameters=parameters, expire=expire, http_method=http_method)
+
+        key = self._normalize_name(clean_name(name))
+        endpoint = urlsplit(self.endpoint_url)
+        path = quote(f'{endpoint.path.rstrip("/")}/{self.bucket_name}/{key}', safe='/~')
+
+        signed_at = datetime.now(UTC) if signed_at is None else datetime.fromtimestamp(signed_at, UTC)
+        amz_date = signed_at.strftime('%Y%m%dT%H%M%SZ')
+        date = amz_date[:8]
+        scope = f'{date}/{self.region_name}/s3/aws4_request'
+        # The canonical query string must be sorted by name
+        query = '&'.join(f'{k}={quote(v, safe="-_.~")}' for k, v in sorted([
+            ('X-Amz-Algorithm', 'AWS4-HMAC-SHA256'),
+            ('X-Amz-Credential', f'{self.access_key}/{scope}'),
+            ('X-Amz-Date', amz_date),
+            ('X-Amz-Expires', str(expire)),
+            ('X-Amz-SignedHeaders', 'host'),
+            *[(RESPONSE_PARAMETERS[k], v) for k, v in (parameters or {}).items()],
+        ]))
+
+        canonical_request = '\n'.join(['GET', path, query, f'host:{endpoint.netloc}', '', 'host', 'UNSIGNED-PAYLOAD'])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+        signature = hmac.new(self.get_signing_key(date), string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        return f'{endpoint.scheme}://{endpoint.netloc}{path}?{query}&X-Amz-Signature={signature}'
+
+    def get_signing_key(self, date):
+        """
+        The signing key only depends on the date, so we only need to derive it once a day.
+        """
+        key_date, signing_key = self.signing_key
+        if key_date != date:
+            signing_key = f'AWS4{self.secret_key}'.encode()
+            for part in [date, self.region_name, 's3', 'aws4_request']:
+                signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+            self.signing_key = (date, signing_key)
+        return signing_key
+
+    def delete_many(self, names):
+        """
+        Delete files with the S3 DeleteObjects API, up to 1000 at a time, rather than making a request per file.
+        Returns the names of any files that could not be deleted. As with delete(), it is not an error to delete
+        something that does not exist, even if B2 reports it as NoSuchKey.
+        """
+        names = list(names)
+        failed = []
+        for i in range(0, len(names), 1000):
+            keys = {self._normalize_name(clean_name(name)): name for name in names[i:i + 1000]}
+            response = self.connection.meta.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys],
+                    'Quiet': True,
+                }
+            )
+            failed += [keys[error['Key']] for error in response.get('Errors', [])
+                       if error['Key'] in keys and error.get('Code') != 'NoSuchKey']
+        return failed
+
+    def list_files(self, path, start_after='', page_size=1000):
+        """
+        Generator yielding pages of (name, last_modified) tuples for the files directly under path, in key order.
+        Unlike listdir() followed by get_modified_time(), this takes each file's modification time from the
+        ListObjectsV2 response rather than making a HEAD request per file. Names are relative to the storage root, as
+        stored in FileFields, so a scan can be resumed by passing the last name seen as start_after.
+        """
+        prefix = self._normalize_name(clean_name(path))
+        # The prefix needs to end with a slash, but if the root is empty, leave it.
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        root = self._normalize_name('')
+
+        kwargs = {
+            'Bucket': self.bucket_name,
+            'Delimiter': '/',
+            'Prefix': prefix,
+            'PaginationConfig': {'PageSize': page_size},
+        }
+        if start_after:
+            kwargs['StartAfter'] = self._normalize_name(clean_name(start_after))
+
+        paginator = self.connection.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            files = [(entry['Key'][len(root):], entry['LastModified'])
+                     for entry in page.get('Contents', ()) if entry['Key'] != prefix]
+            if len(files) > 0:
+                yield files
+
+    def create_multipart_upload(self, name, content_type=None):
+        """
+        Start a multipart upload of the named file, returning its upload id. The parts can then be uploaded directly
+        to B2 from the browser with URLs from sign_upload_part().
+        """
+        kwargs = {'ContentType': content_type} if content_type else {}
+        response = self.connection.meta.client.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(clean_name(name)),
+            **kwargs
+        )
+        return response['UploadId']
+
+    def sign_upload_part(self, name, upload_id, part_number, expire=None):
+        """
+        Presigned PUT URL for uploading a part of a multipart upload.
+        """
+        return self.connection.meta.client.generate_presigned_url(
+            'upload_part',
+            Params={
+                'Bucket': self.bucket_name,
+                'Key': self._normalize_name(clean_name(name)),
+                'UploadId': upload_id,
+                'PartNumber': part_number,
+            },
+            ExpiresIn=expire or self.querystring_expire,  # noqa
+        )
+
+    def list_parts(self, name, upload_id):
+        """
+        Parts of a multipart upload that have been uploaded so far, as dicts with PartNumber, Size and ETag, so that an
+        interrupted upload can carry on from where it left off.
+        """
+        paginator = self.connection.meta.client.get_paginator('list_parts')
+        return [{key: part[key] for key in ['PartNumber', 'Size', 'ETag']}
+                for page in paginator.paginate(Bucket=self.bucket_name,
+                                               Key=self._normalize_name(clean_name(name)),
+                                               UploadId=upload_id)
+                for part in page.get('Parts', ())]
+
+    def complete_multipart_upload(self, name, upload_id, parts):
+        """
+        Assemble the uploaded parts, a list of dicts with PartNumber and ETag, into the named file.
+        """
+        self.connection.meta.client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(clean_name(name)),
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']}
+                                       for part in sorted(parts, key=lambda part: part['PartNumber'])]},
+        )
+
+    def abort_multipart_upload(self, name, upload_id):
+        """
+        Cancel a multipart upload, deleting any parts that have been uploaded.
+        """
+        self.connection.meta.client.abort_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(clean_name(name)),
+            UploadId=upload_id,
+        )
@@ -3,24 +3,36 @@ from django.urls import path
 
 import cattube.core.api
 from cattube.core import views
+from cattube.settings import ASYNC_VIEWS
 
 urlpatterns = [
     # Website
     path('', views.VideoListView.as_view(), name='home'),
     path('reset', views.VideoResetView.as_view(), name='reset'),
-    path('search', views.VideoSearchView.as_view(), name='search'),
+    path('search', (views.AsyncVideoSearchView if ASYNC_VIEWS else views.VideoSearchView).as_view(), name='search'),
     path('login', auth_views.LoginView.as_view(), name='login'),
     path('logout', auth_views.LogoutView.as_view(), name='logout'),
     path('upload', views.VideoCreateView.as_view(), name='upload'),
 
-    path('videos/result', views.VideoResultView.as_view(), name='result'),
+    path('videos/result/<str:search_id>/<int:page>/<int:video_id>', views.VideoResultView.as_view(), name='result'),
     path('videos/<str:video_id>', views.VideoDetailView.as_view(), name='watch'),
     path('videos/delete/<str:video_id>', views.VideoDeleteView.as_view(), name='delete'),
 
     # REST API
     path('api/videos/delete', cattube.core.api.delete_videos),
+    path('api/videos/delete/<int:job_id>', cattube.core.api.deletion_job_detail, name='deletion_job'),
     path('api/videos/index', cattube.core.api.index_videos),
     path('api/videos/status', cattube.core.api.get_status),
+    path('api/videos/changes',
+         cattube.core.api.get_status_changes_async if ASYNC_VIEWS else cattube.core.api.get_status_changes),
     path('api/videos/', cattube.core.api.receive_notification_from_transcoder, name='notification'),
+    path('api/indexing/notification', cattube.core.api.receive_notification_from_twelve_labs,
+         name='indexing_notification'),
     path('api/videos/<str:video_id>', cattube.core.api.video_detail, name='video_detail'),
+    path('api/uploads', cattube.core.api.create_upload, name='uploads'),
+    path('api/uploads/<str:upload_id>', cattube.core.api.multipart_upload, name='multipart_upload'),
+    path('api/uploads/<str:upload_id>/parts/<int:part_number>', cattube.core.api.sign_upload_part,
+         name='upload_part'),
+    path('api/uploads/<str:upload_id>/complete', cattube.core.api.complete_upload, name='complete_upload'),
+    path('api/metrics', cattube.core.api.export_metrics, name='metrics'),
 ]